@@ -0,0 +1,225 @@
+# batch.py
+# Several aggregations of one pointfile, sharing one pass of preparation
+#
+# A dashboard asks several questions of the same pointfile - uptime by version, the % of time some
+# property is true, how many devices reported in each bin, the up/down transitions... Run one by one, each
+# re-codes the ids, re-sorts the rows by device, re-runs the timer and re-fills the properties it needs.
+# run() takes a list of aggregations and does each of those steps once, on first use, for all of them:
+#     sorted check   once (the rows must be in time order, as for percent_of_time_where())
+#     ids and sort   once
+#     timer          once per distinct timeout
+#     ffill          once per property (whether it's grouped by or measured)
+# and the bins (origin, size, count) are the same for every aggregation.
+#
+#     up, present = run(df, [UptimeBy("version", "15min")], "5min")[0]
+#
+# The results are the same as those of the separate queries (query.version_bin_sums(),
+# engine.timeout_transitions()). This is the NumPy engine; with numba a single query.version_bin_sums()
+# runs as one compiled sweep instead (see kernels.py), which doesn't share its work.
+
+import numpy as np
+import pandas as pd
+
+import engine
+import profiling
+import query
+
+
+class Sweep:
+    # The shared preparation, worked out the first time an aggregation asks for it
+    def __init__(self, df, bin_size, origin=None, num_bins=None, devices=None):
+        self.df = df
+        self.ts = engine._timestamps(df["$ts"])
+        if (self.ts[1:] < self.ts[:-1]).any():
+            raise ValueError("The pointfile's rows must be sorted by \"$ts\"")
+        self.n = len(self.ts)
+        self.size = pd.Timedelta(bin_size).value
+        self.origin, self.num_bins = query._layout(self.ts, self.size, origin, num_bins)
+        self.end = self.ts[-1] if self.n else 0
+        self.devices = devices
+        self._sorted = None
+        self._states = {}
+        self._filled = {}
+
+    def sorted(self):
+        # (codes, ids, order, first, last, ts, nxt) with ts and nxt (each row's next row's time, or the end) in device order
+        if self._sorted is None:
+            with profiling.stage("sort", self.n) as s:
+                codes, ids = engine._id_codes(self.df["$id"], self.devices)
+                order, first, last = engine._device_order(codes)
+                ts = self.ts[order]
+                nxt = np.empty_like(ts)
+                nxt[:-1] = ts[1:]
+                nxt[last] = self.end
+                self._sorted = (codes, ids, order, first, last, ts, nxt)
+                s.rows_out = self.n
+        return self._sorted
+
+    def states(self, timeout):
+        # (row timeouts, up, deadline, expires, after) as in engine._message_states, in device order
+        codes, ids, order, first, last, ts, _ = self.sorted()
+        key = pd.Timedelta(timeout).value if not isinstance(timeout, (dict, pd.Series)) else id(timeout)
+        if key not in self._states:
+            rows = engine._row_timeouts(timeout, codes, ids)
+            with profiling.stage("timer", self.n) as s:
+                self._states[key] = (rows,) + engine._message_states(ts, first, last, rows if np.ndim(rows) == 0 else rows[order])
+                s.rows_out = self.n
+        return self._states[key]
+
+    def filled(self, prop):
+        # (codes of prop's value forward-filled per device in device order, -1 before the first, and the values)
+        if prop not in self._filled:
+            _, _, order, first, _, _, _ = self.sorted()
+            with profiling.stage("ffill", self.n) as s:
+                groups, values = pd.factorize(self.df[prop])
+                g = groups[order].astype(float)
+                g[g < 0] = np.nan
+                g = engine._ffill(g, first)
+                self._filled[prop] = (np.where(np.isnan(g), -1, g).astype(np.int64), values)
+                s.rows_out = self.n
+        return self._filled[prop]
+
+    def grouping(self, by):
+        # Group codes and index for an aggregation grouped by property `by`, or all in one group "all"
+        if by is None:
+            return np.zeros(self.n, dtype=np.int64), pd.Index(["all"])
+        g, values = self.filled(by)
+        return g, pd.Index(values, name=by)
+
+    def frame(self, acc, index, dtype="timedelta64[ns]"):
+        columns = pd.DatetimeIndex(self.origin + np.arange(self.num_bins) * self.size)
+        return pd.DataFrame(acc.view(dtype) if dtype else acc, index=index, columns=columns)
+
+
+class UptimeBy:
+    # (up_time, present_time) per value of `by` and bin, as query.version_bin_sums()
+    def __init__(self, by="version", timeout=pd.Timedelta(minutes=15)):
+        self.by = by
+        self.timeout = timeout
+
+    def evaluate(self, sweep):
+        _, _, _, _, _, ts, nxt = sweep.sorted()
+        g, index = sweep.grouping(self.by)
+        up_time = np.zeros((len(index), sweep.num_bins), dtype=np.int64)
+        present_time = np.zeros((len(index), sweep.num_bins), dtype=np.int64)
+        if sweep.n:
+            _, up, deadline, expires, after = sweep.states(self.timeout)
+            with profiling.stage("bin split", sweep.n) as s:
+                on = g >= 0
+                query._split(up_time, present_time, g[on], ts[on], nxt[on], up[on], deadline[on], expires[on], after[on], sweep.origin, sweep.size)
+                s.rows_out = up_time.size
+        return sweep.frame(up_time, index), sweep.frame(present_time, index)
+
+
+class TimeWhere:
+    # (true_time, known_time) per value of `by` (or all devices) and bin: the device-time for which boolean
+    # property prop was true, and for which it was known at all. Each row's value holds until the device's
+    # next row, and its last row's until the end of the pointfile
+    def __init__(self, prop, by=None):
+        self.prop = prop
+        self.by = by
+
+    def evaluate(self, sweep):
+        _, _, _, _, _, ts, nxt = sweep.sorted()
+        g, index = sweep.grouping(self.by)
+        true_time = np.zeros((len(index), sweep.num_bins), dtype=np.int64)
+        known_time = np.zeros((len(index), sweep.num_bins), dtype=np.int64)
+        if sweep.n:
+            v, values = sweep.filled(self.prop)
+            with profiling.stage("bin split", sweep.n) as s:
+                on = (g >= 0) & (v >= 0)
+                truth = np.asarray(values, dtype=bool)[v[on]].astype(np.int64) if len(values) else np.zeros(0, dtype=np.int64)
+                engine._add_to_bins(known_time, g[on], ts[on], nxt[on], np.ones(on.sum(), dtype=np.int64), sweep.origin, sweep.size)
+                engine._add_to_bins(true_time, g[on], ts[on], nxt[on], truth, sweep.origin, sweep.size)
+                s.rows_out = true_time.size
+        return sweep.frame(true_time, index), sweep.frame(known_time, index)
+
+
+class DeviceCount:
+    # Number of distinct devices with a row in each bin, per value of `by` (or all devices)
+    def __init__(self, by=None):
+        self.by = by
+
+    def evaluate(self, sweep):
+        codes, _, order, _, _, ts, _ = sweep.sorted()
+        g, index = sweep.grouping(self.by)
+        counts = np.zeros((len(index), sweep.num_bins), dtype=np.int64)
+        with profiling.stage("bin split", sweep.n) as s:
+            b = (ts - sweep.origin) // sweep.size
+            on = (g >= 0) & (b >= 0) & (b < sweep.num_bins)
+            cells = np.unique((codes[order][on].astype(np.int64) * len(index) + g[on]) * sweep.num_bins + b[on])
+            np.add.at(counts.reshape(-1), cells % (len(index) * sweep.num_bins), 1)
+            s.rows_out = counts.size
+        return sweep.frame(counts, index, dtype=None)
+
+
+class Transitions:
+    # The "$ts", "$id", "up" transition rows, as engine.timeout_transitions()
+    def __init__(self, timeout=pd.Timedelta(minutes=15)):
+        self.timeout = timeout
+
+    def evaluate(self, sweep):
+        if sweep.n == 0:
+            return engine.timeout_transitions(sweep.df, self.timeout)
+        _, _, order, first, _, _, _ = sweep.sorted()
+        rows, up, _, expires, after = sweep.states(self.timeout)
+        return engine._transition_rows(sweep.ts, sweep.df["$id"], order, first, rows, up, expires, after, sweep.df["$ts"])
+
+
+def run(df, aggregations, bin_size, origin=None, num_bins=None, devices=None):
+    # Evaluate each aggregation on the pointfile df, returning their results in the same order
+    sweep = Sweep(df, bin_size, origin, num_bins, devices)
+    return [a.evaluate(sweep) for a in aggregations]
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import benchmark
+    import percent
+    import sample
+
+    print("FUNCTIONAL TEST")
+    df = pd.DataFrame(percent.rows, columns=percent.names)
+    df["up"] = df["up"].astype(bool)
+    uptime, up_where, where_by_version, counts, transitions = run(df, [
+        UptimeBy("version", sample.TIMEOUT), TimeWhere("up"), TimeWhere("up", by="version"), DeviceCount(),
+        Transitions(sample.TIMEOUT)], sample.BIN_SIZE)
+    expected = query.version_bin_sums(df, sample.TIMEOUT, sample.BIN_SIZE)
+    ok = uptime[0].equals(expected[0]) and uptime[1].equals(expected[1])
+    ok &= transitions.equals(engine.timeout_transitions(df, sample.TIMEOUT))
+    ok &= where_by_version[0].sum().equals(up_where[0].loc["all"]) and where_by_version[1].equals(uptime[1])
+
+    # Minute by minute, each device's latest "up" until the last row
+    true_minutes = np.zeros(up_where[0].shape[1], dtype=np.int64)
+    for _, rows in df.groupby("$id"):
+        for minute in pd.date_range(rows["$ts"].iloc[0], df["$ts"].iloc[-1], freq="1min", inclusive="left"):
+            true_minutes[(minute - up_where[0].columns[0]) // sample.BIN_SIZE] += rows.loc[rows["$ts"] <= minute, "up"].iloc[-1]
+    ok &= (up_where[0].loc["all"] == pd.to_timedelta(true_minutes, unit="min")).all()
+    reported = df.groupby((df["$ts"] - counts.columns[0]) // sample.BIN_SIZE)["$id"].nunique()
+    ok &= (counts.loc["all"].to_numpy() == reported.reindex(range(counts.shape[1]), fill_value=0).to_numpy()).all()
+    print(query.uptime_percent(*up_where).round(1))
+
+    # Rows out of time order are refused rather than summed wrongly
+    try:
+        run(sample.pointfile().sample(frac=1, random_state=0), [UptimeBy("version", sample.TIMEOUT)], sample.BIN_SIZE)
+        ok = False
+    except ValueError:
+        pass
+
+    # A fleet: the batch against the same queries run separately
+    fleet = benchmark.fleet(20_000)
+    fleet["charging"] = (fleet["$id"].str[-1] < "5").where(fleet["version"].notna())
+    aggregations = [UptimeBy("version", "15min"), UptimeBy("version", "30min"), TimeWhere("charging", by="version"), DeviceCount("version")]
+    t = time.time()
+    run(fleet, aggregations, "10min")
+    together = time.time() - t
+    t = time.time()
+    for aggregation in aggregations:
+        run(fleet, [aggregation], "10min")
+    print("{} aggregations together {:.0f}ms, separately {:.0f}ms".format(len(aggregations), together * 1000, (time.time() - t) * 1000))
+    if ok:
+        print("PASSED\n")
+    else:
+        print("FAILED")
+        sys.exit(-1)
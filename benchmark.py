@@ -0,0 +1,193 @@
+# benchmark.py
+# Throughput benchmarks for the engines, with a history so that regressions show up as soon as they land
+#
+# Rather than doubling the 19-row sample 16 times, this generates a synthetic fleet: every device starts in
+# the keyframe, then sends a heartbeat every `heartbeat` (with some jitter), some heartbeats are lost
+# (dropout), and some devices are upgraded to the next version part way through. Each engine is run over a
+# sweep of fleet sizes, and rows/sec, peak memory and per-stage timings (see profiling.py) are appended to a
+# JSON history file.
+#
+# Usage: python benchmark.py [--devices 1000,10000,100000] [--history bench_history.json] [--check]
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import engine
+import kernels
+import profiling
+import query
+from devices import DeviceDictionary
+
+TIMEOUT = pd.Timedelta(minutes=15)
+BIN_SIZE = pd.Timedelta(minutes=5)
+
+
+def fleet(devices, heartbeat=pd.Timedelta(minutes=5), dropout=0.05, upgrade=0.2, span=pd.Timedelta(hours=6),
+          versions=3, start=pd.Timestamp("2021-01-01"), seed=0):
+    # A synthetic pointfile, sorted by time
+    rng = np.random.default_rng(seed)
+    heartbeat, span, start = pd.Timedelta(heartbeat).value, pd.Timedelta(span).value, pd.Timestamp(start).value
+    beats = max(1, span // heartbeat)
+
+    device = np.repeat(np.arange(devices), beats)
+    phase = rng.integers(0, heartbeat, devices)
+    jitter = rng.integers(-heartbeat // 10, heartbeat // 10 + 1, devices * beats)
+    ts = start + phase[device] + np.tile(np.arange(beats), devices) * heartbeat + jitter
+    keep = (rng.random(devices * beats) >= dropout) & (ts < start + span)
+    device, ts = device[keep], ts[keep]
+
+    # Each upgraded device reports its new version with its first message after the upgrade
+    version = np.full(len(ts), None, dtype=object)
+    old = rng.integers(1, versions + 1, devices)
+    upgraded = rng.random(devices) < upgrade
+    upgrade_at = start + rng.integers(0, span, devices)
+    after = upgraded[device] & (ts >= upgrade_at[device])
+    first_after = after & ~np.concatenate([[False], after[:-1] & (device[1:] == device[:-1])])
+    version[first_after] = (np.minimum(old[device[first_after]] + 1, versions + 1)).astype(str)
+
+    # Keyframe: every device, with its version, at the start
+    device = np.concatenate([np.arange(devices), device])
+    ts = np.concatenate([np.full(devices, start), ts])
+    version = np.concatenate([old.astype(str).astype(object), version])
+    order = np.argsort(ts, kind="stable")
+    return pd.DataFrame({
+        "$ts": ts[order].view("datetime64[ns]"),
+        "$id": pd.Series(np.char.add("device-", device[order].astype(str))),
+        "version": version[order]})
+
+def _run_encode(df):
+    return DeviceDictionary().encode(df["$id"])
+
+def _run_timeout(df):
+    return engine.timeout_transitions(df, TIMEOUT)
+
+def _run_percent(df):
+    transitions = engine.timeout_transitions(df, TIMEOUT)
+    num_bins = max(1, -(-(df["$ts"].iloc[-1] - df["$ts"].iloc[0]) // BIN_SIZE))
+    return engine.uptime_by_bin(transitions, df["$ts"].iloc[0], BIN_SIZE, num_bins)
+
+def _run_version(df):
+    return query.version_bin_sums(df, TIMEOUT, BIN_SIZE)
+
+ENGINES = {"encode": _run_encode, "timeout": _run_timeout, "percent": _run_percent, "version": _run_version}
+
+def _rss_run(name, df, send):
+    ENGINES[name](df)
+    send.send(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3)
+
+def _peak_rss(name, df):
+    # Peak RSS in MB of one run. This process's ru_maxrss only ever grows over a sweep, so the run is in a
+    # forked child, whose peak starts from this process's RSS when it forks (the fleet included)
+    context = multiprocessing.get_context("fork")
+    receive, send = context.Pipe(duplex=False)
+    child = context.Process(target=_rss_run, args=(name, df, send))
+    child.start()
+    rss = receive.recv()
+    child.join()
+    return rss
+
+def measure(name, df, repeat=3):
+    # Best of `repeat` timings, then one more run under tracemalloc for peak memory, and one for peak RSS
+    best, best_stages = None, None
+    for _ in range(repeat):
+        with profiling.Profile() as profile:
+            t = time.perf_counter()
+            ENGINES[name](df)
+            took = time.perf_counter() - t
+        if best is None or took < best:
+            best, best_stages = took, {stage: totals["seconds"] for stage, totals in profile.stages.items()}
+    tracemalloc.start()
+    ENGINES[name](df)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "engine": name,
+        "rows": len(df),
+        "seconds": best,
+        "rows_per_sec": len(df) / best,
+        "peak_traced_mb": peak / 1e6,
+        "max_rss_mb": _peak_rss(name, df),
+        "stages": best_stages}
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+FLEET = ("heartbeat", "dropout", "upgrade", "span", "numba")
+
+def compare(history, params, results, tolerance=0.2):
+    # Cases that are more than `tolerance` slower than the best earlier run of the same case on the same fleet
+    regressions = []
+    for r in results:
+        earlier = [p["rows_per_sec"] for run in history for p in run["results"]
+                   if all(run["params"].get(k) == params[k] for k in FLEET)
+                   and p["engine"] == r["engine"] and p["devices"] == r["devices"]]
+        if earlier and r["rows_per_sec"] < (1 - tolerance) * max(earlier):
+            regressions.append((r, max(earlier)))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pointfile engines")
+    parser.add_argument("--devices", default="1000,10000,100000", help="Comma-separated fleet sizes to sweep")
+    parser.add_argument("--heartbeat", default="5min")
+    parser.add_argument("--dropout", type=float, default=0.05)
+    parser.add_argument("--upgrade", type=float, default=0.2)
+    parser.add_argument("--span", default="6h")
+    parser.add_argument("--engines", default=",".join(ENGINES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--history", default="bench_history.json")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Fractional slowdown that counts as a regression")
+    parser.add_argument("--check", action="store_true", help="Exit non-zero if any case has regressed")
+    parser.add_argument("--no-numba", action="store_true", help="Use the NumPy engines even if numba is installed")
+    args = parser.parse_args(argv)
+    kernels.USE_NUMBA = not args.no_numba
+
+    results = []
+    for n in [int(d) for d in args.devices.split(",")]:
+        df = fleet(n, pd.Timedelta(args.heartbeat), args.dropout, args.upgrade, pd.Timedelta(args.span))
+        df["$id"] = df["$id"].astype("category")
+        for name in args.engines.split(","):
+            r = measure(name, df, args.repeat)
+            r["devices"] = n
+            results.append(r)
+            print("{engine:8} {devices:>9,} devices {rows:>11,} rows {rows_per_sec:>13,.0f} rows/sec {peak_traced_mb:>9,.1f} MB peak {max_rss_mb:>9,.1f} MB RSS  ".format(**r)
+                  + " ".join("{}={:.0f}ms".format(k, v * 1000) for k, v in r["stages"].items()))
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            history = json.load(f)
+    params = {k: v for k, v in vars(args).items() if k not in ("history", "check", "no_numba")}
+    params["numba"] = kernels.enabled()
+    regressions = compare(history, params, results, args.tolerance)
+    for r, best in regressions:
+        print("REGRESSION: {} with {:,} devices ran at {:,.0f} rows/sec, best was {:,.0f}".format(
+            r["engine"], r["devices"], r["rows_per_sec"], best))
+
+    history.append({
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": _commit(),
+        "params": params,
+        "results": results})
+    with open(args.history, "w") as f:
+        json.dump(history, f, indent=1)
+
+    return 1 if args.check and regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
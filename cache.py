@@ -0,0 +1,179 @@
+# cache.py
+# A cache of finished bins, so repeated "uptime by version" queries only compute the bins they haven't seen
+#
+# A bin [S, E) can't change once event time has passed E + TIMEOUT (in fact once it has passed E; the extra
+# TIMEOUT is a margin). Such closed bins are stored in an sqlite file, keyed by (pointfile, bin start,
+# bin size, timeout, grouping property), and the least recently used are evicted once there are more than
+# max_bins. A query looks up its closed bins, computes the rest (the missing ones and those still open),
+# and stitches the two together.
+#
+# The missing bins are computed from just the rows they need: the rows within them, plus each device's
+# last two rows before them (its state at the start of the first missing bin depends on its last message
+# and the one before that - see engine._message_states), carrying their forward-filled `by` value.
+
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import engine
+import query
+
+
+def identity(path):
+    # Identifies a pointfile file, changing if the file does
+    st = os.stat(path)
+    return "{}:{}:{}".format(os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+def _timeout_key(timeout):
+    if isinstance(timeout, (dict, pd.Series)):
+        items = sorted((str(k), pd.Timedelta(v).value) for k, v in dict(timeout).items())
+        return "per-device:" + hashlib.sha1(json.dumps(items).encode()).hexdigest()
+    return str(pd.Timedelta(timeout).value)
+
+def _max_timeout(timeout):
+    if isinstance(timeout, (dict, pd.Series)):
+        return max(pd.Timedelta(v).value for v in dict(timeout).values())
+    return pd.Timedelta(timeout).value
+
+
+class BinCache:
+    def __init__(self, path, max_bins=100_000):
+        self.max_bins = max_bins
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS bins (
+            pointfile TEXT, bin_size INTEGER, timeout TEXT, by TEXT, bin_start INTEGER,
+            groups TEXT, up BLOB, present BLOB, used INTEGER,
+            PRIMARY KEY (pointfile, bin_size, timeout, by, bin_start))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS bins_used ON bins (used)")
+        self.clock = self.db.execute("SELECT COALESCE(MAX(used), 0) FROM bins").fetchone()[0]  # For LRU order
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM bins").fetchone()[0]
+
+    def get(self, key, starts):
+        # {bin start: (group values, up ns, present ns)} for whichever of the bins are cached
+        if len(starts) == 0:
+            return {}
+        wanted = set(int(s) for s in starts)
+        rows = self.db.execute(
+            "SELECT bin_start, groups, up, present FROM bins WHERE pointfile=? AND bin_size=? AND timeout=? AND by=? AND bin_start BETWEEN ? AND ?",
+            key + (min(wanted), max(wanted))).fetchall()
+        found = {}
+        for start, groups, up, present in rows:
+            if start in wanted:
+                found[start] = (json.loads(groups), np.frombuffer(up, dtype=np.int64), np.frombuffer(present, dtype=np.int64))
+        self.clock += 1
+        self.db.executemany("UPDATE bins SET used=? WHERE pointfile=? AND bin_size=? AND timeout=? AND by=? AND bin_start=?",
+                            [(self.clock,) + key + (start,) for start in found])
+        self.db.commit()
+        return found
+
+    def put(self, key, bins):
+        # Store {bin start: (group values, up ns, present ns)}, then evict down to max_bins
+        self.clock += 1
+        self.db.executemany("INSERT OR REPLACE INTO bins VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+            key + (int(start), json.dumps(groups), np.asarray(up, dtype=np.int64).tobytes(),
+                   np.asarray(present, dtype=np.int64).tobytes(), self.clock)
+            for start, (groups, up, present) in bins.items()])
+        excess = len(self) - self.max_bins
+        if excess > 0:
+            self.db.execute("DELETE FROM bins WHERE rowid IN (SELECT rowid FROM bins ORDER BY used LIMIT ?)", (excess,))
+        self.db.commit()
+
+
+def _context(ts, codes, groups, start, stop):
+    # Row numbers (in time order) of the rows needed for bins [start, stop), and their `by` codes (forward-filled
+    # for the rows before start)
+    lo = np.searchsorted(ts, start, side="left")
+    hi = np.searchsorted(ts, stop, side="left")
+    before = np.zeros(0, dtype=np.int64)
+    before_groups = np.zeros(0, dtype=np.int64)
+    if lo > 0:
+        order, first, last = engine._device_order(codes[:lo])
+        g = groups[:lo][order].astype(float)
+        g[g < 0] = np.nan
+        g = engine._ffill(g, first)
+        ends = np.flatnonzero(last)
+        pick = np.concatenate([ends, (ends - 1)[~first[ends]]])
+        before = order[pick]
+        before_groups = np.where(np.isnan(g[pick]), -1, g[pick]).astype(np.int64)
+        o = np.argsort(before, kind="stable")
+        before, before_groups = before[o], before_groups[o]
+    rows = np.concatenate([before, np.arange(lo, hi)])
+    return rows, np.concatenate([before_groups, groups[lo:hi]])
+
+def version_bin_sums(cache, source, df, timeout, bin_size, origin=None, num_bins=None, by="version", devices=None):
+    # Same result as query.version_bin_sums(df, ...), reusing the closed bins cached for `source` (the pointfile's identity)
+    ts = engine._timestamps(df["$ts"])
+    size = pd.Timedelta(bin_size).value
+    origin, num_bins = query._layout(ts, size, origin, num_bins)
+    groups, values = pd.factorize(df[by])
+    index = pd.Index(values, name=by)
+    up_time = np.zeros((len(values), num_bins), dtype=np.int64)
+    present_time = np.zeros((len(values), num_bins), dtype=np.int64)
+    if len(ts) == 0:
+        return query._frames(up_time, present_time, index, origin, size)
+
+    end = ts[-1]
+    key = (source, size, _timeout_key(timeout), by)
+    starts = origin + np.arange(num_bins) * size
+    closed = starts + size + _max_timeout(timeout) <= end
+    cached = cache.get(key, starts[closed])
+    for b, start in enumerate(starts):
+        if int(start) in cached:
+            cached_groups, up, present = cached[int(start)]
+            rows = index.get_indexer(cached_groups)
+            up_time[rows, b] = up
+            present_time[rows, b] = present
+
+    missing = np.flatnonzero(~np.isin(starts, np.array(list(cached), dtype=np.int64)))
+    if len(missing):
+        first, last = missing[0], missing[-1] + 1
+        codes, ids = engine._id_codes(df["$id"], devices)
+        rows, row_groups = _context(ts, codes, groups, starts[first], starts[last - 1] + size)
+        up, present = query._bin_sums(ts[rows], codes[rows], row_groups, end, engine._row_timeouts(timeout, codes[rows], ids),
+                                      starts[first], size, len(values), last - first)
+        up_time[:, missing] = up[:, missing - first]
+        present_time[:, missing] = present[:, missing - first]
+
+        # Store the newly computed bins that are closed, with just the groups that were present
+        new = {}
+        for b in missing[closed[missing]]:
+            on = np.flatnonzero(present_time[:, b])
+            new[int(starts[b])] = ([v.item() if hasattr(v, "item") else v for v in values[on]], up_time[on, b], present_time[on, b])
+        if new:
+            cache.put(key, new)
+    return query._frames(up_time, present_time, index, origin, size)
+
+def pointfile_sums(cache, path, timeout, bin_size, origin=None, num_bins=None, by="version"):
+    # version_bin_sums() for a Parquet pointfile, identified by its path, size and modification time
+    import pointfile    # Only here, so that caching in-memory frames doesn't need pyarrow
+    return version_bin_sums(cache, identity(path), pointfile.read(path, [by]), timeout, bin_size, origin, num_bins, by)
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    import sample
+
+    print("FUNCTIONAL TEST")
+    df = sample.pointfile()
+    cache = BinCache(os.path.join(tempfile.mkdtemp(), "bins.sqlite"), max_bins=4)
+    expected_up, expected_present = query.version_bin_sums(df, sample.TIMEOUT, sample.BIN_SIZE)
+    results = [version_bin_sums(cache, "sample", df, sample.TIMEOUT, sample.BIN_SIZE) for _ in range(2)]
+    cached = len(cache)
+    # A window starting part way through mostly comes from the cache
+    window = version_bin_sums(cache, "sample", df, sample.TIMEOUT, sample.BIN_SIZE, origin="2021-01-01 00:10", num_bins=4)
+    if (all(up.equals(expected_up) and present.equals(expected_present) for up, present in results) and cached == 4
+            and window[0].equals(query.version_bin_sums(df, sample.TIMEOUT, sample.BIN_SIZE, origin="2021-01-01 00:10", num_bins=4)[0])):
+        print("PASSED\n")
+    else:
+        print("FAILED\n", results[-1][0], "\n", expected_up)
+        sys.exit(-1)
@@ -0,0 +1,265 @@
+# chunked.py
+# Out-of-core versions of timeout() and percent_of_time_where(), for pointfiles too big for memory
+#
+# The time-sorted pointfile is fed through a chunk (a window of rows) at a time, e.g. from
+# pointfile.batches() or pd.read_csv(chunksize=...). Between chunks all that is carried is per-device
+# state (each device's last message and its still-pending timeout) plus the few timeout rows that have
+# been worked out but can't be emitted yet because a later chunk might still put rows in front of them.
+# So memory is bounded by the chunk size plus O(devices), and the output is exactly that of the whole-file
+# versions, in the same order.
+#
+# The ordering rule is that of timeout(): rows are merged by time, a message before a timeout with the
+# same timestamp, and otherwise in the order of the row they came from. After a chunk whose last row is
+# at L, every message so far can be emitted, and every timeout before L. A timeout at or after L has to
+# wait, as the next chunk could start with a message at L.
+
+import numpy as np
+import pandas as pd
+
+import engine
+import profiling
+from devices import DeviceDictionary
+
+
+class ChunkedTimeout:
+    # engine.timeout_transitions() (and so timeout.timeout()) a chunk at a time
+    def __init__(self, timeout, devices=None):
+        self.timeout = timeout
+        self.devices = devices if devices is not None else DeviceDictionary()
+        self.rows = 0   # Rows seen so far, so every row has its index in the whole pointfile
+        self.like = pd.Series(dtype="datetime64[ns]")   # The latest chunk's "$ts" and "$id", for the output's dtypes
+        self.id_dtype = object
+
+        # Per device, indexed by code. The device's last message, whose timeout is still to be decided
+        self.tracked = np.zeros(0, dtype=bool)
+        self.pending = np.zeros(0, dtype=bool)
+        self.last_seen = np.zeros(0, dtype=np.int64)
+        self.deadline = np.zeros(0, dtype=np.int64)
+        self.up = np.zeros(0, dtype=bool)
+        self.after = np.zeros(0, dtype=bool)
+        self.src = np.zeros(0, dtype=np.int64)
+
+        # Timeout transitions that are decided but can't be emitted yet: (ts, src, code, up)
+        self.held = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool))
+
+    def _grow(self):
+        n = len(self.devices) - len(self.tracked)
+        if n > 0:
+            self.tracked = np.concatenate([self.tracked, np.zeros(n, dtype=bool)])
+            self.pending = np.concatenate([self.pending, np.zeros(n, dtype=bool)])
+            self.last_seen = np.concatenate([self.last_seen, np.zeros(n, dtype=np.int64)])
+            self.deadline = np.concatenate([self.deadline, np.zeros(n, dtype=np.int64)])
+            self.up = np.concatenate([self.up, np.zeros(n, dtype=bool)])
+            self.after = np.concatenate([self.after, np.zeros(n, dtype=bool)])
+            self.src = np.concatenate([self.src, np.zeros(n, dtype=np.int64)])
+
+    def update(self, df):
+        # Feed the next chunk. Returns the transitions ("$ts", "$id", "up") that are now certain
+        n = len(df)
+        self.like = df["$ts"].iloc[:0]
+        self.id_dtype = df["$id"].dtype
+        if n == 0:
+            return self._frame(*(a[:0] for a in self.held))
+        ts = engine._timestamps(df["$ts"])
+        with profiling.stage("ids", n) as s:
+            codes = self.devices.encode(df["$id"]).astype(np.int64)
+            self._grow()
+            s.rows_out = n
+        timeout = engine._row_timeouts(self.timeout, codes, self.devices.ids)
+        src = self.rows + np.arange(n)
+        self.rows += n
+        horizon = ts[-1]
+
+        with profiling.stage("timer", n) as s:
+            order, first, last = engine._device_order(codes)
+            ts, codes, src = ts[order], codes[order], src[order]
+            if np.ndim(timeout):
+                timeout = timeout[order]
+            seen = first & self.tracked[codes]  # First row in this chunk of a device we have had rows for
+
+            # The closed form of engine._message_states(), with each device's last message carried in as its previous row
+            prev = np.empty_like(ts)
+            prev[1:] = ts[:-1]
+            prev[first] = self.last_seen[codes[first]]
+            new = first & ~seen
+            up = ~new & (ts - prev <= 2 * timeout)
+            after = new | (ts == prev)
+            deadline = ts + timeout
+            nxt = np.empty_like(ts)
+            nxt[:-1] = ts[1:]
+            expires = np.where(last, deadline < horizon, nxt > deadline)   # A device's last message here expires if nothing later can stop it
+
+            # Pending timeouts fire if they come before the device's next message, or before the end of this
+            # chunk if the device has no message in it (a message at exactly the deadline beats it)
+            next_message = np.full(len(self.pending), np.iinfo(np.int64).max)
+            next_message[codes[first]] = ts[first]
+            decided = self.pending & ((next_message < np.iinfo(np.int64).max) | (self.deadline < horizon))
+            fires = decided & (self.deadline < next_message)
+
+            before = np.empty_like(up)  # State of the device just before each message
+            before[1:] = np.where(expires[:-1], after[:-1], up[:-1])
+            c = codes[first]
+            before[first] = np.where(fires[c], self.after[c], self.up[c]) & ~new[first]
+            s.rows_out = n
+
+        with profiling.stage("eventify", n) as s:
+            message = new | (up != before)
+            timeout_row = expires & (after != up)
+            fired = np.flatnonzero(fires & (self.after != self.up))
+            rows = (
+                np.concatenate([ts[message], deadline[timeout_row], self.deadline[fired], self.held[0]]),
+                np.concatenate([src[message], src[timeout_row], self.src[fired], self.held[1]]),
+                np.concatenate([codes[message], codes[timeout_row], fired, self.held[2]]),
+                np.concatenate([up[message], after[timeout_row], self.after[fired], self.held[3]]),
+                np.concatenate([np.zeros(message.sum(), dtype=bool), np.ones(timeout_row.sum() + len(fired) + len(self.held[0]), dtype=bool)]))
+            s.rows_out = len(rows[0])
+
+        # Timeouts that fired leave their device in its post-timeout state. Then remember each device's last
+        # message; unless it has already expired, its timeout is decided by a later chunk
+        self.pending[decided] = False
+        self.up[fires] = self.after[fires]
+        c = codes[last]
+        pending = ~expires[last]
+        self.tracked[c] = True
+        self.pending[c] = pending
+        self.last_seen[c] = ts[last]
+        self.deadline[c] = deadline[last]
+        self.up[c] = np.where(pending, up[last], after[last])
+        self.after[c] = after[last]
+        self.src[c] = src[last]
+
+        with profiling.stage("merge", len(rows[0])) as s:
+            ready = ~rows[4] | (rows[0] < horizon)
+            self.held = tuple(a[~ready] for a in rows[:4])
+            result = self._emit(*(a[ready] for a in rows))
+            s.rows_out = len(result)
+        return result
+
+    def finish(self):
+        # The end of the pointfile: every pending timeout fires
+        fired = np.flatnonzero(self.pending & (self.after != self.up))
+        self.up[self.pending] = self.after[self.pending]
+        self.pending[:] = False
+        rows = (np.concatenate([self.deadline[fired], self.held[0]]), np.concatenate([self.src[fired], self.held[1]]),
+                np.concatenate([fired, self.held[2]]), np.concatenate([self.after[fired], self.held[3]]),
+                np.ones(len(fired) + len(self.held[0]), dtype=bool))
+        self.held = tuple(a[:0] for a in self.held)
+        return self._emit(*rows)
+
+    def _emit(self, ts, src, codes, up, is_timeout):
+        o = np.lexsort((src, is_timeout, ts))
+        return self._frame(ts[o], src[o], codes[o], up[o])
+
+    def _frame(self, ts, src, codes, up):
+        ids = self.devices.decode(codes)
+        dtype = self.id_dtype
+        if isinstance(dtype, pd.CategoricalDtype) and not ids.isin(dtype.categories).all():
+            dtype = dtype.categories.dtype  # Devices from other chunks that this chunk's categories don't have
+        return pd.DataFrame({"$ts": engine._datetimes(ts, self.like), "$id": ids.astype(dtype).array, "up": up})
+
+
+class ChunkedUptimeByBin:
+    # engine.uptime_by_bin() (and so percent.percent_of_time_where()) a chunk of "$ts", "$id", "up" rows at a time
+    def __init__(self, origin, bin_size, num_bins, devices=None):
+        self.origin = pd.Timestamp(origin).value
+        self.bin_size = pd.Timedelta(bin_size).value
+        self.num_bins = num_bins
+        self.devices = devices if devices is not None else DeviceDictionary()
+        self.tracked = np.zeros(0, dtype=bool)
+        self.last_seen = np.zeros(0, dtype=np.int64)
+        self.up = np.zeros(0)   # Each device's current (forward-filled) state, NaN until it has one
+        self.acc = np.zeros((0, num_bins), dtype=np.int64)
+        self.like = pd.Series(dtype="datetime64[ns]")   # The latest chunk's "$ts", for the resolution of up_time
+
+    def update(self, df):
+        n = len(df)
+        self.like = df["$ts"].iloc[:0]
+        if n == 0:
+            return
+        ts = engine._timestamps(df["$ts"])
+        codes = self.devices.encode(df["$id"]).astype(np.int64)
+        grow = len(self.devices) - len(self.tracked)
+        if grow > 0:
+            self.tracked = np.concatenate([self.tracked, np.zeros(grow, dtype=bool)])
+            self.last_seen = np.concatenate([self.last_seen, np.zeros(grow, dtype=np.int64)])
+            self.up = np.concatenate([self.up, np.full(grow, np.nan)])
+            self.acc = np.concatenate([self.acc, np.zeros((grow, self.num_bins), dtype=np.int64)])
+
+        with profiling.stage("ffill", n) as s:
+            order, first, last = engine._device_order(codes)
+            ts, codes = ts[order], codes[order]
+            up = df["up"].to_numpy(dtype=float)[order]
+            # Carry each device's state into its first row here, if that row doesn't say
+            carried = first & np.isnan(up)
+            up[carried] = self.up[codes[carried]]
+            up = engine._ffill(up, first)
+            s.rows_out = n
+
+        with profiling.stage("bin split", n) as s:
+            # The interval from each device's previous row (which may be in an earlier chunk) up to each row
+            seen = first & self.tracked[codes]
+            c = codes[seen]
+            prev_up = self.up[c]
+            known = ~np.isnan(prev_up)
+            engine._add_to_bins(self.acc, c[known], self.last_seen[c[known]], ts[seen][known], prev_up[known].astype(np.int64),
+                                self.origin, self.bin_size, open_ended=True)
+            end = np.empty_like(ts)
+            end[:-1] = ts[1:]
+            inner = ~last & ~np.isnan(up)
+            engine._add_to_bins(self.acc, codes[inner], ts[inner], end[inner], up[inner].astype(np.int64),
+                                self.origin, self.bin_size, open_ended=True)
+            s.rows_out = self.acc.size
+
+        c = codes[last]
+        self.tracked[c] = True
+        self.last_seen[c] = ts[last]
+        self.up[c] = up[last]
+
+    def finish(self):
+        # Same Series as engine.uptime_by_bin(): each device's last state holds until the start of the last bin
+        c = np.flatnonzero(self.tracked & ~np.isnan(self.up))
+        end = np.maximum(self.last_seen[c], self.origin + (self.num_bins - 1) * self.bin_size)
+        engine._add_to_bins(self.acc, c, self.last_seen[c], end, self.up[c].astype(np.int64), self.origin, self.bin_size, open_ended=True)
+        tracked = np.flatnonzero(self.tracked)
+        ids = self.devices.decode(tracked)
+        o = np.argsort(ids.to_numpy(), kind="stable")   # Ids in sorted order, as groupby() gives them
+        acc = self.acc[tracked[o]]
+        index = pd.MultiIndex.from_product([ids[o], np.arange(self.num_bins, dtype=float)], names=["$id", "bin_number"])
+        return pd.Series(engine._timedeltas(acc.reshape(-1), self.like), index=index, name="up_time")
+
+
+def timeout_transitions(chunks, timeout, devices=None):
+    # Yield the transitions for an iterable of time-sorted chunks, as each chunk makes them certain
+    chunked = ChunkedTimeout(timeout, devices)
+    for df in chunks:
+        yield chunked.update(df)
+    yield chunked.finish()
+
+def uptime_by_bin(chunks, origin, bin_size, num_bins, devices=None):
+    # Up-time per ("$id", "bin_number") for an iterable of time-sorted chunks of "$ts", "$id", "up" rows
+    chunked = ChunkedUptimeByBin(origin, bin_size, num_bins, devices)
+    for df in chunks:
+        chunked.update(df)
+    return chunked.finish()
+
+
+if __name__ == "__main__":
+    import sys
+    import sample
+
+    print("FUNCTIONAL TEST")
+    df = sample.pointfile()
+    expected = engine.timeout_transitions(df, sample.TIMEOUT)
+    for size in (1, 2, 5, len(df)):
+        chunks = (df.iloc[i:i + size] for i in range(0, len(df), size))
+        result = pd.concat(list(timeout_transitions(chunks, sample.TIMEOUT)), ignore_index=True)
+        if not result.equals(expected):
+            print("FAILED with chunks of", size, "\n", result, "\n", expected)
+            sys.exit(-1)
+
+        chunks = (expected.iloc[i:i + size] for i in range(0, len(expected), size))
+        bins = uptime_by_bin(chunks, df["$ts"].iloc[0], sample.BIN_SIZE, 10)
+        if not bins.equals(engine.uptime_by_bin(expected, df["$ts"].iloc[0], sample.BIN_SIZE, 10)):
+            print("FAILED: bins with chunks of", size, "\n", bins)
+            sys.exit(-1)
+    print("PASSED\n")
@@ -0,0 +1,71 @@
+# devices.py
+# A persistent dictionary of device ids
+#
+# Device ids are strings (or anything else hashable), which makes every groupby on "$id" slow. A
+# DeviceDictionary gives each id a dense int32 code the first time it is seen, and keeps it, so the same
+# device has the same code in every pointfile and every query. Engines can then work on contiguous int
+# arrays, and keep per-device state in flat arrays indexed by code.
+
+import numpy as np
+import pandas as pd
+
+
+class DeviceDictionary:
+    def __init__(self, ids=()):
+        self.ids = pd.Index(ids)   # Code -> id
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _lookup(self, uniques):
+        # Codes for an array of distinct ids, adding any we haven't seen
+        codes = self.ids.get_indexer(uniques)
+        new = codes < 0
+        if new.any():
+            codes[new] = len(self.ids) + np.arange(new.sum())
+            self.ids = self.ids.append(pd.Index(uniques[new]))
+        return codes.astype(np.int32)
+
+    def encode(self, ids):
+        # int32 codes for a Series of ids (NaN gets -1)
+        if isinstance(ids.dtype, pd.CategoricalDtype):   # Only the categories need looking up
+            codes, uniques = ids.cat.codes.to_numpy(), ids.cat.categories.to_numpy()
+        else:
+            codes, uniques = pd.factorize(ids)
+        lookup = np.append(self._lookup(uniques), np.int32(-1))
+        return lookup[codes]
+
+    def decode(self, codes):
+        return self.ids.take(codes)
+
+    def save(self, path):
+        ids = self.ids.to_numpy()
+        if ids.dtype == object:
+            ids = ids.astype(str)
+        np.save(path, ids, allow_pickle=False)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        return cls(np.load(path, mmap_mode=mmap_mode, allow_pickle=False))
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import tempfile
+    import sample
+
+    print("FUNCTIONAL TEST")
+    df = sample.pointfile()
+    devices = DeviceDictionary()
+    codes = devices.encode(df["$id"])
+    again = devices.encode(df["$id"].astype("category").iloc[::-1])
+    path = os.path.join(tempfile.mkdtemp(), "devices.npy")
+    devices.save(path)
+    loaded = DeviceDictionary.load(path)
+    if (list(devices.decode(codes)) == list(df["$id"]) and (again == codes[::-1]).all()
+            and (loaded.encode(df["$id"]) == codes).all() and len(loaded) == 3):
+        print("PASSED\n")
+    else:
+        print("FAILED")
+        sys.exit(-1)
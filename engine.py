@@ -0,0 +1,242 @@
+# engine.py
+# NumPy engines for the pointfile queries
+#
+# These work directly on int64 timestamps and integer-coded device ids instead of chains of
+# pandas concat/sort/groupby, and produce exactly the same results as the pandas versions
+# in timeout.py and working_percent.py (which remain the reference implementations).
+
+import numpy as np
+import pandas as pd
+
+import kernels
+import profiling
+
+
+def _id_codes(ids, devices=None):
+    # Integer-code the device ids, using the shared DeviceDictionary if there is one. Otherwise
+    # categoricals already carry their codes
+    if devices is not None:
+        codes = devices.encode(ids)
+        return codes, devices.ids
+    if isinstance(ids.dtype, pd.CategoricalDtype):
+        return ids.cat.codes.to_numpy(), pd.CategoricalIndex(ids.cat.categories, dtype=ids.dtype)
+    codes, uniques = pd.factorize(ids, sort=True)
+    return codes, pd.Index(uniques)
+
+def _timestamps(ts):
+    # int64 ns. Times already in ns (and without a time zone) are viewed rather than copied, read-only
+    if ts.dtype == "datetime64[ns]":
+        view = ts.to_numpy().view(np.int64)
+        view.flags.writeable = False
+        return view
+    return ts.to_numpy(dtype="datetime64[ns]").view(np.int64)
+
+def _datetimes(ns, like):
+    # int64 ns times back as datetimes with the resolution (and time zone) of the "$ts" Series like
+    times = pd.DatetimeIndex(ns.view("datetime64[ns]"))
+    if like.dt.tz is not None:
+        times = times.tz_localize("UTC").tz_convert(like.dt.tz)
+    return times.as_unit(like.dt.unit).array
+
+def _timedeltas(ns, like):
+    # int64 ns durations as timedeltas with the resolution of the "$ts" Series like
+    return pd.TimedeltaIndex(ns.view("timedelta64[ns]")).as_unit(like.dt.unit).array
+
+def _row_timeouts(timeout, codes, ids):
+    # Timeout in ns: an int for one Timedelta, or an array (one per row) for a mapping of $id -> Timedelta
+    if not isinstance(timeout, (dict, pd.Series)):
+        return pd.Timedelta(timeout).value
+    per_id = pd.to_timedelta(pd.Series(timeout).reindex(ids)).to_numpy(dtype="timedelta64[ns]").view(np.int64)
+    rows = per_id[codes]
+    missing = rows == np.iinfo(np.int64).min    # NaT
+    if missing.any():
+        raise ValueError("No timeout given for devices " + str(list(pd.unique(ids[codes[missing]]))))
+    return rows
+
+def _device_order(codes):
+    # Group rows by device. The sort is stable, so each device's rows stay in time order.
+    # NumPy only radix-sorts 16-bit keys, so sort on the low then the high half of the codes
+    codes = codes.astype(np.uint32)
+    n = len(codes)
+    order = np.argsort((codes & 0xFFFF).astype(np.uint16), kind="stable")
+    high = codes >> 16
+    if high.any():
+        high = high.astype(np.uint8 if high.max() < 256 else np.uint16)    # Narrow before gathering it
+        order = order[np.argsort(high[order], kind="stable")]
+    if n and codes.max() > 2 * n + 65536:   # E.g. -1 for a missing id: too sparse to count
+        c = codes[order]
+        first = np.ones(n, dtype=bool)
+        first[1:] = c[1:] != c[:-1]
+    else:
+        # In device order the codes are just the sorted codes, so where each device's rows end comes from
+        # counting them, rather than from gathering the codes into that order
+        counts = np.bincount(codes)
+        ends = np.cumsum(counts[counts > 0])
+        first = np.zeros(n, dtype=bool)
+        first[:1] = True
+        first[ends[:-1]] = True
+    last = np.ones(n, dtype=bool)
+    last[:-1] = first[1:]
+    return order, first, last
+
+def _to_rows(order, values):
+    # Scatter an array in device order back into row order
+    out = np.empty_like(values)
+    out[order] = values
+    return out
+
+def _message_states(ts, first, last, timeout):
+    # ts is in device order (see _device_order). For every message this works out, in closed form, what
+    # timeout() gets from merging in the "potential timeout" rows and running its timer:
+    #   up       - the state of the device from this message onwards
+    #   deadline - when this message's timeout would fire
+    #   expires  - whether it does fire (i.e. the device's next message comes strictly after it)
+    #   after    - the state of the device once it has fired
+    # timeout()'s timer measures from the row before the message, which is either the previous message
+    # or (if that had already timed out) its timeout. So a message only brings the device up if it arrives
+    # within 2*timeout of the previous message, and its own timeout only takes the device down if the row
+    # before it was earlier. The first (keyframe) row leaves the device down, but its timeout brings it up.
+    # timeout may be an array in the same order as ts, as long as it is the same for all of a device's rows
+    gap = np.zeros_like(ts)     # Time since the previous row (meaningless at a device's first row)
+    np.subtract(ts[1:], ts[:-1], out=gap[1:])
+
+    up = ~first & (gap <= 2 * timeout)
+    deadline = ts + timeout
+    expires = last.copy()
+    expires[:-1] |= gap[1:] > (timeout if np.ndim(timeout) == 0 else timeout[:-1])
+    after = first | (gap == 0)
+    return up, deadline, expires, after
+
+def timeout_transitions(df, timeout, devices=None, prop=None):
+    # Same "$ts", "$id", "up" transition rows as timeout.timeout(), in the same order. timeout can be a
+    # mapping of $id -> Timedelta, and with prop only the rows reporting that property count (as in timeout())
+    ts = _timestamps(df["$ts"])
+    ids = df["$id"]
+    if prop is not None:
+        reported = df[prop].notna().to_numpy()
+        ts, ids = ts[reported], ids[reported]
+    n = len(ts)
+    if n == 0:
+        return pd.DataFrame({"$ts": df["$ts"].iloc[:0], "$id": df["$id"].iloc[:0], "up": np.zeros(0, dtype=bool)})
+
+    with profiling.stage("sort", n) as s:
+        codes, uniques = _id_codes(ids, devices)
+        order, first, last = _device_order(codes)
+        s.rows_out = n
+    timeout = _row_timeouts(timeout, codes, uniques)
+    with profiling.stage("timer", n) as s:
+        up, deadline, expires, after = _message_states(ts[order], first, last, timeout if np.ndim(timeout) == 0 else timeout[order])
+        s.rows_out = n
+    return _transition_rows(ts, ids, order, first, timeout, up, expires, after, df["$ts"])
+
+def _transition_rows(ts, ids, order, first, timeout, up, expires, after, like):
+    # The transitions DataFrame, from the message states (in device order) of rows ts, ids (in row order).
+    # "$ts" has the resolution of the Series like, and "$id" the dtype of ids
+    n = len(ts)
+    with profiling.stage("eventify", n) as s:
+        before = np.empty_like(up)  # State of the device just before each message
+        before[0] = False
+        before[1:] = np.where(expires[:-1], after[:-1], up[:-1])
+        message_changes = first | (up != before)
+        timeout_changes = expires & (after != up)
+        # The four flags go back into row order together, as bits of one byte per row
+        flags = _to_rows(order, message_changes.view(np.uint8) | timeout_changes.view(np.uint8) << 1
+                         | up.view(np.uint8) << 2 | after.view(np.uint8) << 3)
+        message_src = np.flatnonzero(flags & 1)
+        timeout_src = np.flatnonzero(flags & 2)
+        s.rows_out = len(message_src) + len(timeout_src)
+
+    # Merged into time order as in the mergesort of concat([df, delayed]): a stable sort, so a message goes
+    # before a timeout with the same timestamp. With one timeout the messages and the timeouts are each in
+    # time order already, so the sort just merges the two runs
+    with profiling.stage("merge", len(message_src) + len(timeout_src)) as s:
+        out_ts = np.concatenate([ts[message_src], ts[timeout_src] + (timeout[timeout_src] if np.ndim(timeout) else timeout)])
+        o = np.argsort(out_ts, kind="stable")
+
+        out_up = np.concatenate([flags[message_src] & 4 != 0, flags[timeout_src] & 8 != 0])
+        result = pd.DataFrame({
+            "$ts": _datetimes(out_ts[o], like),
+            "$id": ids.array.take(np.concatenate([message_src, timeout_src])[o]),
+            "up": out_up[o]})
+        s.rows_out = len(result)
+    return result
+
+def _ffill(values, first):
+    # Forward-fill NaNs in a float array in device order, without filling across devices
+    n = len(values)
+    rows = np.arange(n)
+    last_valid = np.maximum.accumulate(np.where(np.isnan(values), -1, rows))
+    device_start = np.maximum.accumulate(np.where(first, rows, 0))
+    filled = values[np.maximum(last_valid, 0)]
+    filled[last_valid < device_start] = np.nan
+    return filled
+
+def _add_to_bins(acc, group, start, end, weight, origin, size, open_ended=False):
+    # Add weight * (overlap of each [start, end) interval with each bin) into acc[group, bin]
+    # Bin k covers [origin + k*size, origin + (k+1)*size). If open_ended the last bin carries on forever
+    num_groups, num_bins = acc.shape
+    start = np.maximum(start, origin)
+    if not open_ended:
+        end = np.minimum(end, origin + num_bins * size)
+    keep = end > start
+    group, start, end, weight = group[keep], start[keep], end[keep], weight[keep]
+
+    first = np.minimum((start - origin) // size, num_bins - 1)
+    last = np.minimum((end - 1 - origin) // size, num_bins - 1)
+    base = group.astype(np.int64) * num_bins
+    flat = acc.reshape(-1)
+
+    same = first == last    # Most intervals sit inside one bin
+    np.add.at(flat, base[same] + first[same], weight[same] * (end[same] - start[same]))
+
+    # Otherwise split into the part in the first bin, the part in the last bin, and whole bins between
+    span = ~same
+    first, last, base, weight = first[span], last[span], base[span], weight[span]
+    np.add.at(flat, base + first, weight * (origin + (first + 1) * size - start[span]))
+    np.add.at(flat, base + last, weight * (end[span] - (origin + last * size)))
+    whole = np.zeros((num_groups, num_bins + 1), dtype=np.int64)   # Counts of whole bins, as differences
+    whole_flat = whole.reshape(-1)
+    np.add.at(whole_flat, base // num_bins * (num_bins + 1) + first + 1, weight)
+    np.add.at(whole_flat, base // num_bins * (num_bins + 1) + last, -weight)
+    acc += np.cumsum(whole[:, :num_bins], axis=1) * size
+
+def uptime_by_bin(df, origin, bin_size, num_bins, devices=None):
+    # Same Series as percent.percent_of_time_where(): total up-time per ("$id", "bin_number"), but each
+    # interval between a device's rows is split across the bin edges arithmetically rather than by
+    # merging NUM_BINS synthetic rows per device into the frame.
+    # With a DeviceDictionary the rows are every device in it, in code order, so results line up across pointfiles
+    ts = _timestamps(df["$ts"])
+    codes, ids = _id_codes(df["$id"], devices)
+    origin = pd.Timestamp(origin).value
+    size = pd.Timedelta(bin_size).value
+    acc = np.zeros((len(ids), num_bins), dtype=np.int64)
+
+    if len(ts) and kernels.enabled():
+        with profiling.stage("sweep", len(ts)) as s:
+            kernels.uptime_by_bin(ts, codes, df["up"].to_numpy(dtype=float), origin, size, acc)
+            s.rows_out = acc.size
+    elif len(ts):
+        with profiling.stage("sort", len(ts)) as s:
+            order, first, last = _device_order(codes)
+            ts = ts[order]
+            codes = codes[order]
+            s.rows_out = len(ts)
+        with profiling.stage("ffill", len(ts)) as s:
+            up = _ffill(df["up"].to_numpy(dtype=float)[order], first)
+            s.rows_out = len(up)
+
+        # Each row's state holds until the device's next row. After its last row it holds until the
+        # start of the last bin (where percent_of_time_where() has its last synthetic row for the device)
+        with profiling.stage("bin split", len(ts)) as s:
+            end = np.empty_like(ts)
+            end[:-1] = ts[1:]
+            end[last] = np.maximum(ts[last], origin + (num_bins - 1) * size)
+            known = ~np.isnan(up)
+            _add_to_bins(acc, codes[known], ts[known], end[known], up[known].astype(np.int64), origin, size, open_ended=True)
+            s.rows_out = acc.size
+
+    with profiling.stage("reduce", acc.size) as s:
+        index = pd.MultiIndex.from_product([ids, np.arange(num_bins, dtype=float)], names=["$id", "bin_number"])
+        result = pd.Series(_timedeltas(acc.reshape(-1), df["$ts"]), index=index, name="up_time")
+        s.rows_out = len(result)
+    return result
@@ -0,0 +1,175 @@
+# intervals.py
+# An interval index of a slow-changing property (e.g. "version") per device
+#
+# A property like "version" is only reported when it changes (or in a keyframe), so every query has to
+# forward-fill it through a groupby on "$id" to know what each row was running. It changes rarely, so the
+# same information fits in a handful of intervals per device: (device code, start, end, value code) in
+# arrays sorted by device then start, with repeats of the same value merged and the last interval running
+# on forever. Built once per pointfile, the index then answers
+#     lookup()     the value at any (device, time), e.g. for every row of a query, instead of an ffill
+#     intersect()  the pieces of any per-device time intervals (e.g. up-time) with each value
+# Both binary-search each device's few intervals, rather than sorting or grouping the queries.
+#
+# Devices are matched by id (through self.ids), so an index built from a whole pointfile serves queries on
+# any part of it. Times before a device first reports the property have no value (-1). A value counts from
+# the time it is reported, so other rows of that device at exactly the same time see it too (they are
+# zero-length intervals, so this changes no sums).
+
+import numpy as np
+import pandas as pd
+
+import engine
+
+FOREVER = np.iinfo(np.int64).max
+
+
+class PropertyIndex:
+    def __init__(self, prop, ids, code, start, end, value, values):
+        self.prop = prop
+        self.ids = ids          # Device code -> $id
+        self.code = code        # One entry per interval, sorted by (code, start)
+        self.start = start
+        self.end = end
+        self.value = value      # Code into self.values
+        self.values = values
+        self.offsets = np.searchsorted(code, np.arange(len(ids) + 1))   # Where each device's intervals start
+
+    @classmethod
+    def build(cls, df, prop, devices=None):
+        # From a pointfile DataFrame of "$ts", "$id" and prop (NaN where the row doesn't report it)
+        codes, ids = engine._id_codes(df["$id"], devices)
+        groups, values = pd.factorize(df[prop])
+        ts = engine._timestamps(df["$ts"])
+        on = groups >= 0
+        c, t, g = codes[on], ts[on], groups[on]
+        order = np.lexsort((t, c))  # Stable, so rows at the same time stay in row order
+        c, t, g = c[order], t[order], g[order]
+
+        # Of rows at the same (device, time) the last counts, then runs of one value merge into one interval
+        keep = np.ones(len(c), dtype=bool)
+        keep[:-1] = (c[1:] != c[:-1]) | (t[1:] != t[:-1])
+        c, t, g = c[keep], t[keep], g[keep]
+        change = np.ones(len(c), dtype=bool)
+        change[1:] = (c[1:] != c[:-1]) | (g[1:] != g[:-1])
+        c, t, g = c[change], t[change], g[change]
+        end = np.full(len(c), FOREVER, dtype=np.int64)
+        same_device = c[1:] == c[:-1]
+        end[:-1][same_device] = t[1:][same_device]
+        return cls(prop, ids, c.astype(np.int64), t, end, g.astype(np.int64), pd.Index(values, name=prop))
+
+    @classmethod
+    def from_pointfile(cls, path, prop, devices=None):
+        import pointfile    # Only here, so that the in-memory index doesn't need pyarrow
+        return cls.build(pointfile.read(path, [prop]), prop, devices)
+
+    def __len__(self):
+        return len(self.code)
+
+    def to_frame(self):
+        return pd.DataFrame({
+            "$id": self.ids[self.code],
+            "start": self.start.view("datetime64[ns]"),
+            "end": np.where(self.end == FOREVER, np.iinfo(np.int64).min, self.end).view("datetime64[ns]"),   # NaT: still running
+            self.prop: self.values[self.value]})
+
+    def _codes(self, codes, ids):
+        # Translate a query's device codes (into ids) into this index's codes (-1 for devices it doesn't know)
+        mapped = self.ids.get_indexer(ids)
+        return np.where(codes >= 0, mapped[np.maximum(codes, 0)], -1)
+
+    def _find(self, codes, ts):
+        # Position of the interval each (code, time) falls in, or -1: a binary search within each device's
+        # intervals, all queries at once, so it takes as many passes as the most intervals any device has bits
+        known = (codes >= 0) & (codes < len(self.offsets) - 1)
+        c = np.where(known, codes, 0)
+        lo = np.where(known, self.offsets[c], 0)
+        hi = np.where(known, self.offsets[c + 1], 0)
+        device_start = lo.copy()
+        while True:
+            searching = lo < hi
+            if not searching.any():
+                break
+            mid = (lo + hi) // 2
+            after = self.start[np.minimum(mid, len(self) - 1)] > ts   # Where the first interval starting after ts is
+            hi = np.where(searching & after, mid, hi)
+            lo = np.where(searching & ~after, mid + 1, lo)
+        return np.where(lo > device_start, lo - 1, -1)
+
+    def lookup(self, codes, ts, ids):
+        # Value code (into self.values) of each (device code, int64 ns time), -1 where there is none yet
+        if len(self) == 0:
+            return np.full(len(ts), -1, dtype=np.int64)
+        found = self._find(self._codes(codes, ids), ts)
+        return np.where(found >= 0, self.value[np.maximum(found, 0)], -1)
+
+    def intersect(self, codes, start, end, ids):
+        # Split intervals [start, end) of devices (codes into ids) by this property's value. Returns
+        # (which input interval, value code, start, end) for each piece, leaving out time with no value
+        codes = self._codes(codes, ids)
+        m = len(codes)
+        empty = np.zeros(0, dtype=np.int64)
+        if len(self) == 0 or m == 0:
+            return empty, empty, empty, empty
+        found = self._find(np.concatenate([codes, codes]), np.concatenate([start, end - 1]))
+        first, last = found[:m], found[m:]
+        first = np.where(first >= 0, first, np.searchsorted(self.code, codes))   # Starts before the device has a value
+        count = np.where((last >= 0) & (end > start), last - first + 1, 0)
+        which = np.repeat(np.arange(m), count)
+        k = first[which] + np.arange(len(which)) - np.repeat(np.cumsum(count) - count, count)
+        return which, self.value[k], np.maximum(start[which], self.start[k]), np.minimum(end[which], self.end[k])
+
+    def uptime_by_value(self, transitions, end):
+        # Total up-time per value from engine.timeout_transitions() output, counting up to time end
+        codes, ids = engine._id_codes(transitions["$id"])
+        ts = engine._timestamps(transitions["$ts"])
+        if len(ts) == 0:
+            return pd.Series(pd.to_timedelta(np.zeros(len(self.values), dtype=np.int64)), index=self.values)
+        order, first, last = engine._device_order(codes)
+        ts = ts[order]
+        nxt = np.empty_like(ts)
+        nxt[:-1] = ts[1:]
+        nxt[last] = max(pd.Timestamp(end).value, ts.max())
+        up = transitions["up"].to_numpy(dtype=bool)[order]
+        which, value, piece_start, piece_end = self.intersect(codes[order][up], ts[up], np.minimum(nxt[up], pd.Timestamp(end).value), ids)
+        total = np.zeros(len(self.values), dtype=np.int64)   # Summed in int64, as float64 would round the ns
+        np.add.at(total, value, piece_end - piece_start)
+        return pd.Series(total.view("timedelta64[ns]"), index=self.values)
+
+
+if __name__ == "__main__":
+    import sys
+    import sample
+    import query
+
+    print("FUNCTIONAL TEST")
+    df = sample.pointfile()
+    index = PropertyIndex.build(df, "version")
+    print(index.to_frame())
+
+    # Lookups agree with forward-filling, including on a part of the pointfile with ids in another order
+    codes, ids = engine._id_codes(df["$id"])
+    filled = df.groupby("$id")["version"].ffill()
+    ok = (index.values[index.lookup(codes, engine._timestamps(df["$ts"]), ids)] == filled).all()
+    part = df.iloc[4:].assign(**{"$id": df["$id"].iloc[4:].astype("category").cat.reorder_categories(["C", "B", "A"])})
+    up, present = query.version_bin_sums(part, sample.TIMEOUT, sample.BIN_SIZE, intervals=index)
+    expected_up, expected_present = query.version_bin_sums(part.assign(version=filled.iloc[4:]), sample.TIMEOUT, sample.BIN_SIZE)
+    ok &= up.equals(expected_up.reindex(up.index)) and present.equals(expected_present.reindex(up.index))
+
+    # Up-time intervals attributed to versions: the same totals as the binned query
+    up_time = index.uptime_by_value(engine.timeout_transitions(df, sample.TIMEOUT), df["$ts"].iloc[-1])
+    print(up_time)
+    expected = query.version_bin_sums(df, sample.TIMEOUT, sample.BIN_SIZE)[0].sum(axis=1)
+    ok &= up_time.equals(expected)
+
+    # And on a fleet whose totals are beyond float64's 2**53 ns, summed exactly in int64 on both sides
+    import benchmark
+    fleet = benchmark.fleet(2000)
+    up_time = PropertyIndex.build(fleet, "version").uptime_by_value(engine.timeout_transitions(fleet, benchmark.TIMEOUT), fleet["$ts"].iloc[-1])
+    bins = query.version_bin_sums(fleet, benchmark.TIMEOUT, benchmark.BIN_SIZE)[0]
+    expected = pd.Series(bins.to_numpy(dtype="timedelta64[ns]").view(np.int64).sum(axis=1).view("timedelta64[ns]"), index=bins.index)
+    ok &= up_time.max().value > 2 ** 53 and up_time.equals(expected.reindex(up_time.index))
+    if ok:
+        print("PASSED\n")
+    else:
+        print("FAILED\n", expected)
+        sys.exit(-1)
@@ -0,0 +1,166 @@
+# kernels.py
+# Compiled per-device sweeps, used by the engines when numba is installed
+#
+# The NumPy engines get their speed from whole-array operations, but each stage (sort by device, timer,
+# ffill, bin split) still makes full-length temporaries, and splitting intervals into bins goes through
+# np.add.at. With numba the same work is one loop over the rows in time order, carrying each device's
+# pending message in per-device arrays: when a device's next row arrives (or the data ends), the interval
+# its previous message started is closed and added straight into the bins. No sort by device is needed.
+#
+# The results are exactly those of the NumPy paths in query._bin_sums() and engine.uptime_by_bin(), which
+# are used when numba isn't installed or USE_NUMBA is set to False (and which, with timeout.py and
+# percent.py, remain the references for the equivalence tests).
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+USE_NUMBA = numba is not None
+
+
+def enabled():
+    return USE_NUMBA and numba is not None
+
+def _jit(f):
+    return numba.njit(cache=True)(f) if numba is not None else f
+
+
+@_jit
+def _add(acc, g, start, end, weight, origin, size, open_ended):
+    # acc[g, bin] += weight * overlap of [start, end) with each bin (see engine._add_to_bins)
+    num_bins = acc.shape[1]
+    if weight == 0:
+        return
+    if start < origin:
+        start = origin
+    if not open_ended and end > origin + num_bins * size:
+        end = origin + num_bins * size
+    k = (start - origin) // size
+    while start < end:
+        if k >= num_bins - 1:
+            acc[g, num_bins - 1] += weight * (end - start)
+            return
+        edge = min(end, origin + (k + 1) * size)
+        acc[g, k] += weight * (edge - start)
+        start = edge
+        k += 1
+
+@_jit
+def _bin_sums(ts, codes, groups, end, timeout, origin, size, up_time, present_time):
+    num_devices = len(timeout)
+    seen = np.zeros(num_devices, dtype=np.bool_)
+    last = np.zeros(num_devices, dtype=np.int64)    # The device's pending message: its time,
+    up = np.zeros(num_devices, dtype=np.bool_)      # the state it brought,
+    after = np.zeros(num_devices, dtype=np.bool_)   # the state once its timeout fires,
+    group = np.full(num_devices, -1, dtype=np.int64)  # and the device's group (forward-filled)
+    for i in range(len(ts)):
+        c = codes[i]
+        t = ts[i]
+        if seen[c]:
+            _close(up_time, present_time, group[c], last[c], t, timeout[c], up[c], after[c], origin, size)
+            up[c] = t - last[c] <= 2 * timeout[c]
+            after[c] = t == last[c]
+        else:
+            seen[c] = True
+            up[c] = False
+            after[c] = True
+        last[c] = t
+        if groups[i] >= 0:
+            group[c] = groups[i]
+    for c in range(num_devices):
+        if seen[c]:
+            _close(up_time, present_time, group[c], last[c], end, timeout[c], up[c], after[c], origin, size)
+
+@_jit
+def _close(up_time, present_time, g, start, nxt, timeout, up, after, origin, size):
+    # A message's interval [start, nxt): up (or not) until its timeout fires, then its after state
+    if g < 0:
+        return
+    fired = min(start + timeout, nxt)
+    _add(present_time, g, start, nxt, 1, origin, size, False)
+    _add(up_time, g, start, fired, np.int64(up), origin, size, False)
+    _add(up_time, g, fired, nxt, np.int64(after), origin, size, False)
+
+@_jit
+def _uptime_by_bin(ts, codes, up, origin, size, acc):
+    num_devices, num_bins = acc.shape
+    seen = np.zeros(num_devices, dtype=np.bool_)
+    last = np.zeros(num_devices, dtype=np.int64)
+    state = np.full(num_devices, np.nan)    # Forward-filled "up"
+    for i in range(len(ts)):
+        c = codes[i]
+        if seen[c] and not np.isnan(state[c]):
+            _add(acc, c, last[c], ts[i], np.int64(state[c]), origin, size, True)
+        seen[c] = True
+        last[c] = ts[i]
+        if not np.isnan(up[i]):
+            state[c] = up[i]
+    tail = origin + (num_bins - 1) * size   # Each device's last state holds until the start of the last bin
+    for c in range(num_devices):
+        if seen[c] and not np.isnan(state[c]):
+            _add(acc, c, last[c], max(last[c], tail), np.int64(state[c]), origin, size, True)
+
+
+def bin_sums(ts, codes, groups, end, timeout, origin, size, num_groups, num_bins):
+    # Same arguments and result as query._bin_sums()
+    up_time = np.zeros((num_groups, num_bins), dtype=np.int64)
+    present_time = np.zeros((num_groups, num_bins), dtype=np.int64)
+    if len(ts) == 0:
+        return up_time, present_time
+    codes = np.asarray(codes, dtype=np.int64)
+    per_device = np.full(codes.max() + 1, timeout if np.ndim(timeout) == 0 else 0, dtype=np.int64)
+    if np.ndim(timeout):
+        per_device[codes] = timeout
+    _bin_sums(ts, codes, np.asarray(groups, dtype=np.int64), np.int64(end), per_device, np.int64(origin), np.int64(size),
+              up_time, present_time)
+    return up_time, present_time
+
+def uptime_by_bin(ts, codes, up, origin, size, acc):
+    # Adds what engine.uptime_by_bin() does into acc (devices x bins); up is float, NaN where not reported
+    _uptime_by_bin(ts, np.asarray(codes, dtype=np.int64), np.asarray(up, dtype=float), np.int64(origin), np.int64(size), acc)
+    return acc
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import pandas as pd
+    import engine
+    import kernels  # The module the engines use, rather than this script's own copy of it
+    import query
+    import sample
+    import benchmark
+
+    print("FUNCTIONAL TEST")
+    if not enabled():
+        print("numba is not installed, so the engines use NumPy\nPASSED\n")
+        sys.exit(0)
+
+    def both(f):
+        results = []
+        for use in (True, False):
+            kernels.USE_NUMBA = use
+            f()   # Once to compile
+            t = time.time()
+            results.append(f())
+            print("{:6} {:8.1f}ms".format("numba" if use else "numpy", (time.time() - t) * 1000))
+        kernels.USE_NUMBA = True
+        return results
+
+    ok = True
+    timeouts = {"A": sample.TIMEOUT, "B": pd.Timedelta(minutes=40), "C": pd.Timedelta(minutes=3)}
+    for df in (sample.pointfile(), benchmark.fleet(5000)):
+        for timeout in (sample.TIMEOUT, timeouts if len(df) < 100 else sample.TIMEOUT):
+            (numba_up, numba_present), (numpy_up, numpy_present) = both(lambda: query.version_bin_sums(df, timeout, "7min"))
+            ok &= numba_up.equals(numpy_up) and numba_present.equals(numpy_present)
+        transitions = engine.timeout_transitions(df, sample.TIMEOUT)
+        numba_bins, numpy_bins = both(lambda: engine.uptime_by_bin(transitions, df["$ts"].iloc[0], sample.BIN_SIZE, 20))
+        ok &= numba_bins.equals(numpy_bins)
+    if ok:
+        print("PASSED\n")
+    else:
+        print("FAILED")
+        sys.exit(-1)
@@ -0,0 +1,369 @@
+# live.py
+# Live ingest: uptime by version updated message by message, as messages arrive
+#
+# Everything else here works on whole frames (or chunks of them). LiveUptime instead takes one message at a
+# time - (time, $id, `by` value or None) - with no DataFrame built per message or per batch. As in hard.py,
+# event time is the latest timestamp seen on any device, and it is only ever moved on by messages.
+#
+# Per message:
+#   * pending timeouts due before the message fire, from a heap of deadlines holding at most one entry per
+#     device (when a device's deadline has moved on since it was pushed, it is pushed again when it comes to
+#     the top, rather than fired)
+#   * the device's state changes exactly as in engine._message_states, moving it between the up and present
+#     counts of its version
+#   * the version whose counts change has its time since its last change added into the open bins
+# so a message costs O(log devices), plus a bin for each bin edge crossed. The other versions' time is only
+# added when bins are read or finalized, which costs O(versions) once per batch.
+#
+# Messages older than event time from a device we already track can't change history that has been
+# counted, so are skipped (as keyframe rows are in StreamingUptime, which this matches - except that a
+# keyframe row at exactly event time can't be told from a new message, so is applied). A device we
+# haven't seen before is taken on with its row's own time, but is only counted from event time: its presence,
+# and its timeout if that is due before event time, take effect at event time.
+#
+# LiveService runs a LiveUptime behind an asyncio queue: producers submit() messages (or send lines of JSON
+# to serve()'s socket), one task applies them in micro-batches, and after every batch each subscriber's
+# queue gets (event time, bins finalized by the batch). bins() reads the open bins at any time. A malformed
+# message is rejected where it comes in - submit() raises ValueError, and the socket replies with a line of
+# {"error": ...} - and any message that still fails to apply is skipped and kept in `errors`, so one bad
+# message never stops the service.
+
+import asyncio
+import collections
+import heapq
+import json
+
+import numpy as np
+import pandas as pd
+
+import streaming
+
+
+class LiveUptime:
+    def __init__(self, timeout, bin_size, origin=None, by="version"):
+        self.timeout = pd.Timedelta(timeout).value
+        self.bin_size = pd.Timedelta(bin_size).value
+        self.origin = None if origin is None else pd.Timestamp(origin).value
+        self.by = by
+        self.event_time = None
+
+        # Per device, indexed by the code in self.codes
+        self.codes = {}         # $id -> code
+        self.last_seen = []
+        self.up = []            # Current state
+        self.after = []         # State once the last message's timeout has fired
+        self.expired = []
+        self.queued = []        # Whether the device has an entry in the deadline heap
+        self.group = []         # Code of the device's `by` value, -1 if not known yet
+        self.deadlines = []     # Heap of (deadline, device code)
+
+        # Per group (value of `by`)
+        self.groups = {}        # Value -> code
+        self.up_count = []
+        self.present_count = []
+        self.since = []         # Time up to which the group's counts have been added into the bins
+        self.open_from = 0      # Bin number of the first open bin
+        self.open_up = []       # Per group, a list of ns per open bin
+        self.open_present = []
+
+    def _group(self, value):
+        code = self.groups.get(value)
+        if code is None:
+            code = self.groups[value] = len(self.groups)
+            self.up_count.append(0)
+            self.present_count.append(0)
+            self.since.append(self.event_time)
+            self.open_up.append([])
+            self.open_present.append([])
+        return code
+
+    def _accrue(self, group, t):
+        # Add the group's up and present counts times the time since its last change into the bins, up to t
+        start = self.since[group]
+        if t <= start:  # Never back over time already added
+            return
+        self.since[group] = t
+        up, present = self.up_count[group], self.present_count[group]
+        if present == 0:
+            return
+        open_up, open_present = self.open_up[group], self.open_present[group]
+        k = (start - self.origin) // self.bin_size - self.open_from
+        while start < t:
+            end = min(t, self.origin + (self.open_from + k + 1) * self.bin_size)
+            while len(open_up) <= k:
+                open_up.append(0)
+                open_present.append(0)
+            open_up[k] += up * (end - start)
+            open_present[k] += present * (end - start)
+            start = end
+            k += 1
+
+    def _change(self, group, t, d_up, d_present):
+        if group >= 0 and (d_up or d_present):
+            self._accrue(group, t)
+            self.up_count[group] += d_up
+            self.present_count[group] += d_present
+
+    def _fire(self, t):
+        # Fire the timeouts due before time t (a message at exactly a deadline beats it)
+        while self.deadlines and self.deadlines[0][0] < t:
+            deadline, code = heapq.heappop(self.deadlines)
+            due = self.last_seen[code] + self.timeout
+            if due > deadline:  # The device has sent a message since this was pushed
+                heapq.heappush(self.deadlines, (due, code))
+                continue
+            self.queued[code] = False
+            self.expired[code] = True
+            self._change(self.group[code], max(deadline, self.event_time), int(self.after[code]) - int(self.up[code]), 0)
+            self.up[code] = self.after[code]
+
+    def ingest(self, ts, device, value=None):
+        # One message: ts in ns (or anything pd.Timestamp takes), the device's $id, and its new `by` value if any
+        if not isinstance(ts, (int, np.integer)):
+            ts = pd.Timestamp(ts).value
+        code = self.codes.get(device)
+        if self.event_time is None:
+            self.event_time = ts
+            if self.origin is None:
+                self.origin = ts - ts % self.bin_size
+        if code is not None and ts < self.event_time:
+            return
+        self._fire(ts)
+        self.event_time = max(self.event_time, ts)
+        group = -1 if value is None or value != value else self._group(value)   # value != value for NaN
+
+        if code is None:
+            code = self.codes[device] = len(self.codes)
+            self.last_seen.append(ts)
+            self.up.append(False)
+            self.after.append(True)
+            self.expired.append(False)
+            self.queued.append(False)
+            self.group.append(group)
+            self._change(group, self.event_time, 0, 1)  # From event time, even if the row is older
+        else:
+            up = ts - self.last_seen[code] <= 2 * self.timeout
+            before = self.group[code]
+            if group < 0:
+                group = before
+            if group != before:
+                self._change(before, ts, -int(self.up[code]), -1)
+                self._change(group, ts, int(up), 1)
+            else:
+                self._change(group, ts, int(up) - int(self.up[code]), 0)
+            self.after[code] = ts == self.last_seen[code]
+            self.last_seen[code] = ts
+            self.up[code] = up
+            self.expired[code] = False
+            self.group[code] = group
+        if not self.queued[code]:
+            heapq.heappush(self.deadlines, (ts + self.timeout, code))
+            self.queued[code] = True
+
+    def ingest_many(self, messages):
+        # A batch of (ts, $id, value) messages. Returns (up_time, present_time) for the bins now finalized
+        for message in messages:
+            self.ingest(*message)
+        return self._finalize()
+
+    def _flush(self):
+        # Bring every group's bins up to event time
+        if self.event_time is not None:
+            self._fire(self.event_time)
+            for group in range(len(self.groups)):
+                self._accrue(group, self.event_time)
+
+    def _arrays(self, count):
+        up = np.zeros((len(self.groups), count), dtype=np.int64)
+        present = np.zeros((len(self.groups), count), dtype=np.int64)
+        for group in range(len(self.groups)):
+            n = min(count, len(self.open_up[group]))
+            up[group, :n] = self.open_up[group][:n]
+            present[group, :n] = self.open_present[group][:n]
+        return up, present
+
+    def _finalize(self):
+        # Bins whose end event time has reached can no longer change
+        self._flush()
+        done = 0
+        if self.event_time is not None:
+            done = max(0, (self.event_time - self.origin) // self.bin_size - self.open_from)
+        up, present = self._arrays(done)
+        for group in range(len(self.groups)):
+            del self.open_up[group][:done]
+            del self.open_present[group][:done]
+        result = streaming._frames(self, up, present, self.open_from)
+        self.open_from += done
+        return result
+
+    def bins(self):
+        # (up_time, present_time) so far for the bins that are still open, up to event time
+        self._flush()
+        if self.event_time is None:
+            return streaming._frames(self, *self._arrays(0), self.open_from)
+        count = (self.event_time - self.origin) // self.bin_size - self.open_from + 1
+        return streaming._frames(self, *self._arrays(count), self.open_from)
+
+
+def _message(ts, device, value=None):
+    # A message as ingest() takes it, with ts in ns, or ValueError if it can't be applied
+    try:
+        if not isinstance(ts, (int, np.integer)):
+            ts = pd.Timestamp(ts).value
+        if ts == pd.NaT.value:
+            raise ValueError("No time")
+        if device is None:
+            raise ValueError("No $id")
+        hash(device)
+        hash(value)
+    except (TypeError, OverflowError) as e:
+        raise ValueError(e) from e
+    return ts, device, value
+
+
+class LiveService:
+    def __init__(self, uptime, max_batch=1024, max_errors=100):
+        self.uptime = uptime
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        self.subscribers = []
+        self.errors = collections.deque(maxlen=max_errors)   # The latest (message, exception) that failed to apply
+
+    async def submit(self, ts, device, value=None):
+        await self.queue.put(_message(ts, device, value))
+
+    async def close(self):
+        # Stop run() once the messages already submitted have been applied
+        await self.queue.put(None)
+
+    def subscribe(self):
+        # A queue that gets (event time, up_time, present_time) after every batch, with the bins it finalized
+        q = asyncio.Queue()
+        self.subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q):
+        self.subscribers.remove(q)
+
+    def bins(self):
+        return self.uptime.bins()
+
+    async def run(self):
+        # Apply messages in micro-batches: whatever has queued up, up to max_batch, without waiting for more
+        running = True
+        while running:
+            batch = [await self.queue.get()]
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            if None in batch:
+                batch = batch[:batch.index(None)]
+                running = False
+            for message in batch:
+                try:
+                    self.uptime.ingest(*message)
+                except (ValueError, TypeError) as e:
+                    self.errors.append((message, e))
+            up, present = self.uptime._finalize()
+            event_time = None if self.uptime.event_time is None else pd.Timestamp(self.uptime.event_time)
+            for q in self.subscribers:
+                q.put_nowait((event_time, up, present))
+
+    async def _connection(self, reader, writer):
+        # Lines of JSON, e.g. {"$ts": "2021-01-01 00:02:00", "$id": "A", "version": "1"}. A line that isn't a
+        # valid message gets a line of {"error": ...} back
+        by = self.uptime.by
+        try:
+            async for line in reader:
+                if not line.strip():
+                    continue
+                try:
+                    message = json.loads(line)
+                    if not isinstance(message, dict) or "$ts" not in message or "$id" not in message:
+                        raise ValueError("A message needs \"$ts\" and \"$id\"")
+                    await self.submit(message["$ts"], message["$id"], message.get(by))
+                except ValueError as e:     # json.JSONDecodeError is a ValueError
+                    writer.write((json.dumps({"error": str(e)}) + "\n").encode())
+                    await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=0):
+        # A local socket to send messages to, as a stand-in for a real message queue
+        return await asyncio.start_server(self._connection, host, port)
+
+if __name__ == "__main__":
+    import sys
+    import sample
+    import query
+
+    print("FUNCTIONAL TEST")
+    df = sample.pointfile()
+    expected_up, expected_present = query.version_bin_sums(df, sample.TIMEOUT, sample.BIN_SIZE)
+    messages = [(row["$ts"], row["$id"], row["version"]) for _, row in df.iterrows()]
+
+    async def main():
+        service = LiveService(LiveUptime(sample.TIMEOUT, sample.BIN_SIZE), max_batch=4)
+        updates = service.subscribe()
+        task = asyncio.create_task(service.run())
+        server = await service.serve()
+        port = server.sockets[0].getsockname()[1]
+
+        # The first half are submitted directly, the rest arrive over the socket. Malformed messages in
+        # between are rejected, or (if they get past submit()) skipped, and the rest still apply
+        rejected = 0
+        for i, message in enumerate(messages[:9]):
+            await service.submit(*message)
+            if i == 4:
+                try:
+                    await service.submit("not a time", "B", "1")
+                except ValueError:
+                    rejected += 1
+                service.queue.put_nowait(("not a time", "B", "1"))
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        for i, (ts, device, version) in enumerate(messages[9:]):
+            writer.write((json.dumps({"$ts": str(ts), "$id": device, "version": version}) + "\n").encode())
+            if i == 2:
+                writer.write(b'not json\n{"$ts": "2021-01-01"}\n{"$ts": "not a time", "$id": "B"}\n')
+        await writer.drain()
+        writer.write_eof()
+        replies = [json.loads(line) for line in (await reader.read()).splitlines()]
+        writer.close()
+        await writer.wait_closed()
+        while service.uptime.event_time != df["$ts"].iloc[-1].value:
+            await asyncio.sleep(0.01)
+        await service.close()
+        await task
+        server.close()
+
+        done = []
+        while not updates.empty():
+            done.append(updates.get_nowait())
+        up, present = service.bins()
+        print(rejected, "rejected,", len(replies), "error replies,", len(service.errors), "skipped")
+        ok = rejected == 1 and len(replies) == 3 and all("error" in r for r in replies) and len(service.errors) == 1
+        return ok, pd.concat([u for _, u, _ in done] + [up], axis=1), pd.concat([p for _, _, p in done] + [present], axis=1)
+
+    ok, up, present = asyncio.run(main())
+    print(query.uptime_percent(up, present).round(1))
+    ok &= up.equals(expected_up) and present.equals(expected_present)
+
+    # A second pointfile whose keyframe has a new device, B, timestamped before event time (and part way
+    # through a bin): B counts from event time, as in StreamingUptime
+    from streaming import StreamingUptime
+    minutes = lambda m: [pd.Timestamp("2021-01-01") + pd.Timedelta(minutes=x) for x in m]
+    first = pd.DataFrame({"$ts": minutes([0, 10, 22]), "$id": ["A"] * 3, "version": ["1", None, None]})
+    second = pd.DataFrame({"$ts": minutes([22, 5, 25, 26]), "$id": ["A", "B", "A", "B"], "version": ["1", "1", None, None]})
+    live, stream = LiveUptime(sample.TIMEOUT, sample.BIN_SIZE), StreamingUptime(sample.TIMEOUT, sample.BIN_SIZE)
+    results = []
+    for df, keyframe in ((first, 0), (second, 2)):
+        results.append((live.ingest_many([(row["$ts"], row["$id"], row["version"]) for _, row in df.iterrows()]),
+                        stream.update(df, keyframe=keyframe)))
+    results.append((live.bins(), stream.bins()))
+    for i in (0, 1):
+        ok &= pd.concat([r[0][i] for r in results], axis=1).equals(pd.concat([r[1][i] for r in results], axis=1))
+    ok &= (pd.concat([r[0][1] for r in results], axis=1) <= 2 * sample.BIN_SIZE).all().all()
+    if ok:
+        print("PASSED\n")
+    else:
+        print("FAILED\n", up, "\n", expected_up)
+        sys.exit(-1)
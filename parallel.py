@@ -0,0 +1,101 @@
+# parallel.py
+# query.version_bin_sums() spread across a pool of worker processes
+#
+# Once the end time of the pointfile is known, devices are independent, so each device can be handled by
+# any worker. Devices are hash-partitioned by their integer code into one shard per worker. The shards are
+# laid out one after another (each still in time order) in shared memory, so a worker just attaches to the
+# block and takes its slice; no DataFrames are pickled across. Per-device timeouts go in the block too, as
+# one more array of each row's timeout. Each worker returns its small (versions x bins) partial sums, which
+# are added together at the end.
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import os
+
+import numpy as np
+import pandas as pd
+
+import engine
+import query
+
+
+def _shard(codes, shards):
+    # Multiplicative hash, so shards stay balanced however the codes were assigned
+    return ((codes.astype(np.uint64) * np.uint64(2654435761)) % np.uint64(2**32) % np.uint64(shards)).astype(np.uint16)
+
+def _shard_sums(name, n, start, stop, timeout, params):
+    # Runs in a worker: the partial sums for rows start..stop of the shared arrays. timeout is None when
+    # it is per row, in the block
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = np.ndarray((3 if timeout is not None else 4, n), dtype=np.int64, buffer=shm.buf)
+    ts, codes, groups = arrays[:3, start:stop]
+    rows = timeout if timeout is not None else arrays[3, start:stop]
+    end, origin, size, num_groups, num_bins = params
+    result = query._bin_sums(ts, codes, groups, end, rows, origin, size, num_groups, num_bins)  # Works on its own copies, so nothing refers to the block after this
+    del arrays, ts, codes, groups, rows
+    shm.close()
+    return result
+
+def version_bin_sums(df, timeout, bin_size, origin=None, num_bins=None, by="version", workers=None, devices=None):
+    # Same result as query.version_bin_sums(), including for a mapping of $id -> Timedelta
+    workers = workers or os.cpu_count() or 1
+    ts = engine._timestamps(df["$ts"])
+    codes, ids = engine._id_codes(df["$id"], devices)
+    groups, values = pd.factorize(df[by])
+    timeout = engine._row_timeouts(timeout, codes, ids)
+    size = pd.Timedelta(bin_size).value
+    origin, num_bins = query._layout(ts, size, origin, num_bins)
+    params = (ts[-1] if len(ts) else 0, origin, size, len(values), num_bins)
+    if workers == 1 or len(ts) == 0:
+        return query._frames(*query._bin_sums(ts, codes, groups, params[0], timeout, *params[1:]), pd.Index(values, name=by), origin, size)
+
+    shard = _shard(codes, workers)
+    order = np.argsort(shard, kind="stable")    # Keeps each shard in time order
+    bounds = np.searchsorted(shard[order], np.arange(workers + 1))
+
+    n = len(ts)
+    per_row = np.ndim(timeout) > 0
+    k = 4 if per_row else 3
+    shm = shared_memory.SharedMemory(create=True, size=k * n * 8)
+    try:
+        arrays = np.ndarray((k, n), dtype=np.int64, buffer=shm.buf)
+        arrays[0] = ts[order]
+        arrays[1] = codes[order]
+        arrays[2] = groups[order]
+        if per_row:
+            arrays[3] = timeout[order]
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(_shard_sums, shm.name, n, bounds[w], bounds[w + 1], None if per_row else timeout, params)
+                       for w in range(workers)]
+            partials = [f.result() for f in futures]
+        del arrays
+    finally:
+        shm.close()
+        shm.unlink()
+
+    up_time = sum(p[0] for p in partials)
+    present_time = sum(p[1] for p in partials)
+    return query._frames(up_time, present_time, pd.Index(values, name=by), origin, size)
+
+
+if __name__ == "__main__":
+    import sys
+    import sample
+
+    print("FUNCTIONAL TEST")
+    df = sample.pointfile()
+    up, present = version_bin_sums(df, sample.TIMEOUT, sample.BIN_SIZE, workers=2)
+    expected_up, expected_present = query.version_bin_sums(df, sample.TIMEOUT, sample.BIN_SIZE)
+    ok = up.equals(expected_up) and present.equals(expected_present)
+
+    # Per-device timeouts: B is given longer before it is deemed offline
+    timeouts = {"A": sample.TIMEOUT, "B": pd.Timedelta(minutes=40), "C": sample.TIMEOUT}
+    for workers in (1, 2):
+        up, present = version_bin_sums(df, timeouts, sample.BIN_SIZE, workers=workers)
+        expected = query.version_bin_sums(df, timeouts, sample.BIN_SIZE)
+        ok &= up.equals(expected[0]) and present.equals(expected[1]) and not up.equals(expected_up)
+    if ok:
+        print("PASSED\n")
+    else:
+        print("FAILED\n", up, "\n", expected_up)
+        sys.exit(-1)
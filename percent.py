@@ -7,7 +7,8 @@ import numpy as np
 import time
 import datetime
 import sys
-from line_profiler import LineProfiler
+import engine
+import profiling
 
 NUM_BINS = 10
 BIN_SIZE = pd.Timedelta(minutes=5)   # What size time bins do we want on the output?
@@ -46,78 +47,112 @@ rows = [
     ]
 
 def percent_of_time_where(df):
-    assert df.index.is_monotonic and df.index.is_unique # Grouping and sorting will be slower if these are not true
+    assert df.index.is_monotonic_increasing and df.index.is_unique # Grouping and sorting will be slower if these are not true
 
     # Create bins
-    all_ids = df["$id"].unique()
-    num_ids = len(all_ids)
+    with profiling.stage("bin split", len(df)) as s:
+        all_ids = df["$id"].unique()
+        num_ids = len(all_ids)
     
-    bins = pd.DataFrame()
-    date = pd.Timestamp("2021-01-01T00:00:00")
-    for b in range(NUM_BINS):  #  Relatively few bins, so OK to iterate at high level
-        dates = np.full(num_ids, date)  # Twice as fast as using Python lists
-        bin_numbers = np.full(num_ids, b)
-        new_bins = pd.DataFrame({'$ts' : dates, '$id' : all_ids, 'bin_number' : bin_numbers})
-        bins = pd.concat([bins, new_bins])
-        date += BIN_SIZE
+        bins = pd.DataFrame()
+        date = pd.Timestamp("2021-01-01T00:00:00")
+        for b in range(NUM_BINS):  #  Relatively few bins, so OK to iterate at high level
+            dates = np.full(num_ids, date)  # Twice as fast as using Python lists
+            bin_numbers = np.full(num_ids, b)
+            new_bins = pd.DataFrame({'$ts' : dates, '$id' : all_ids, 'bin_number' : bin_numbers})
+            bins = pd.concat([bins, new_bins])
+            date += BIN_SIZE
+        s.rows_out = len(bins)
     
     # these_bins = pd.DataFrame({'$ts' : pd.bdate_range('2021-01-01', freq='5min', periods = NUM_BINS).tolist(), 'bin_number' : range(NUM_BINS)})
     
     # Merge bins with existing events (can we use merge(), to avoid sort()? Everything already sorted. TODO: Try sort_index() if we ensure the indices are correct first
-    df = pd.concat([df, bins], ignore_index=True) # Some functions hate duplicate indexes, so re-index (most don't pay any attention). Doesn't affect speed of this.
-    df = df.sort_values(by="$ts", kind="mergesort") # Mergesort fastest, because largely already sorted
+    with profiling.stage("merge", len(df) + len(bins)) as s:
+        df = pd.concat([df, bins], ignore_index=True) # Some functions hate duplicate indexes, so re-index (most don't pay any attention). Doesn't affect speed of this.
+        df = df.sort_values(by="$ts", kind="mergesort") # Mergesort fastest, because largely already sorted
+        s.rows_out = len(df)
      
-    groups = df.groupby("$id", sort=False)  # No need to sort
+    with profiling.stage("ffill", len(df)) as s:
+        groups = df.groupby("$id", sort=False)  # No need to sort
     
-    df[["version", "up", "bin_number"]] = groups[["version", "up", "bin_number"]].ffill() # The groupby is slow - around 900k rows/sec
+        df[["version", "up", "bin_number"]] = groups[["version", "up", "bin_number"]].ffill() # The groupby is slow - around 900k rows/sec
+        s.rows_out = len(df)
 
-    df['time_delta'] = groups['$ts'].shift(-1) - df['$ts'] 
-    # df['time_delta'] = groups['$ts'].transform(lambda x : x.diff().shift(-1)) # Slow
-    # df['time_delta'] = groups['$ts'].diff()    # Slow if lots of groups (https://stackoverflow.com/questions/53150700/why-the-groupby-diff-is-so-slower)
-    # df['time_delta'] = groups['time_delta'].shift(-1)     # Forward-looking deltas
+    with profiling.stage("timer", len(df)) as s:
+        df['time_delta'] = groups['$ts'].shift(-1) - df['$ts'] 
+        # df['time_delta'] = groups['$ts'].transform(lambda x : x.diff().shift(-1)) # Slow
+        # df['time_delta'] = groups['$ts'].diff()    # Slow if lots of groups (https://stackoverflow.com/questions/53150700/why-the-groupby-diff-is-so-slower)
+        # df['time_delta'] = groups['time_delta'].shift(-1)     # Forward-looking deltas
 
-    df['up_time'] = df['time_delta'] * df['up']
+        df['up_time'] = df['time_delta'] * df['up']
+        s.rows_out = len(df)
      
-    result = df.groupby(['$id', 'bin_number'])['up_time'].sum()
+    with profiling.stage("reduce", len(df)) as s:
+        result = df.groupby(['$id', 'bin_number'])['up_time'].sum()
+        s.rows_out = len(result)
 
     return result
 
 def run_percent():
     global df_big
-    result = percent_of_time_where(df_big)
-
-df = pd.DataFrame(rows, columns = names)
-df.set_index("$ts")
-
-print("Functional test")
-result = percent_of_time_where(df)
-print(result)
-
-# sys.exit(0)
-
-print("Performance test")
-df_big = pd.DataFrame(rows, columns = names)
-for i in range(16):
-    df2 = df_big.copy()    # Create an identical dataframe later in time
-    span = df2["$ts"].iloc[-1] - df2["$ts"].iloc[0]
-    df2["$ts"] += span
-    df_big = pd.concat([df_big, df2], ignore_index=True)    # Ignore index so we get a nice monotonic, non-duplicate index (which will make some functions much faster)
-# Randomise IDs to 100k values
-df_big['$id'] = np.random.randint(1, 100_000, df_big.shape[0])  # This slows it down from around 1.2M rows/sec to around 14k!
-df_big['$id'] = df_big['$id'].astype("category")    # IDs are arguably categorical, which improves speed. Or they are pd.StringDtype() which is slower. They are not numbers.
-print(df_big)
-
-lprofiler = LineProfiler()
-lprofiler.add_function(percent_of_time_where)
-lp_wrapper = lprofiler(run_percent)
-t1 = time.time()
-lp_wrapper()
-t2 = time.time()
-lprofiler.print_stats()
-
-print("Took {time:,}ms to do {rows:,} rows, which is {speed:,} rows/sec".format(
-    time=int((t2-t1)*1000),
-    rows=len(df_big),
-    speed=int(len(df_big)/(t2-t1)))
-    )
+    return percent_of_time_where(df_big)
 
+def run_engine():
+    global df_big
+    return engine.uptime_by_bin(df_big, pd.Timestamp("2021-01-01T00:00:00"), BIN_SIZE, NUM_BINS)
+
+if __name__ == "__main__":
+    df = pd.DataFrame(rows, columns = names)
+    df.set_index("$ts")
+
+    print("Functional test")
+    result = percent_of_time_where(df)
+    print(result)
+
+    engine_result = engine.uptime_by_bin(df, pd.Timestamp("2021-01-01T00:00:00"), BIN_SIZE, NUM_BINS)
+    if engine_result.equals(result):
+        print("PASSED\n")
+    else:
+        print("FAILED: engine gives\n", engine_result)
+        sys.exit(-1)
+
+    # sys.exit(0)
+
+    print("Performance test")
+    df_big = pd.DataFrame(rows, columns = names)
+    for i in range(16):
+        df2 = df_big.copy()    # Create an identical dataframe later in time
+        span = df2["$ts"].iloc[-1] - df2["$ts"].iloc[0]
+        df2["$ts"] += span
+        df_big = pd.concat([df_big, df2], ignore_index=True)    # Ignore index so we get a nice monotonic, non-duplicate index (which will make some functions much faster)
+    # Randomise IDs to 100k values
+    df_big['$id'] = np.random.randint(1, 100_000, df_big.shape[0])  # This slows it down from around 1.2M rows/sec to around 14k!
+    df_big['$id'] = df_big['$id'].astype("category")    # IDs are arguably categorical, which improves speed. Or they are pd.StringDtype() which is slower. They are not numbers.
+    print(df_big)
+
+    with profiling.Profile() as engine_profile:
+        t1 = time.time()
+        engine_result = run_engine()
+        t2 = time.time()
+    print(engine_profile.report())
+    print("Engine took {time:,}ms to do {rows:,} rows, which is {speed:,} rows/sec".format(
+        time=int((t2-t1)*1000),
+        rows=len(df_big),
+        speed=int(len(df_big)/(t2-t1)))
+        )
+
+    with profiling.Profile() as profile:
+        t1 = time.time()
+        result = run_percent()
+        t2 = time.time()
+    print(profile.report())
+
+    print("Took {time:,}ms to do {rows:,} rows, which is {speed:,} rows/sec".format(
+        time=int((t2-t1)*1000),
+        rows=len(df_big),
+        speed=int(len(df_big)/(t2-t1)))
+        )
+
+    if not engine_result.equals(result):
+        print("FAILED: engine does not match percent_of_time_where()")
+        sys.exit(-1)
@@ -0,0 +1,105 @@
+# pointfile.py
+# Reading pointfiles from Parquet
+#
+# Only "$ts", "$id" and the properties a query needs are read. The file's end time comes from the row-group
+# statistics, so it is known without scanning the data (see the notes in hard.py). "$id" is read as a
+# dictionary, so it arrives as a categorical (codes into a small array of ids) rather than one string per
+# row. Row groups are streamed as record batches, so a pointfile never has to be in memory all at once.
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+import chunked
+from streaming import StreamingUptime
+
+
+def end_time(path):
+    # Latest "$ts" in the file, from the row-group statistics
+    meta = pq.ParquetFile(path).metadata
+    column = meta.schema.to_arrow_schema().get_field_index("$ts")
+    latest = None
+    for r in range(meta.num_row_groups):
+        stats = meta.row_group(r).column(column).statistics
+        if stats is None or not stats.has_min_max:
+            # No statistics written, so fall back to reading just this row group's timestamps
+            ts = pq.ParquetFile(path).read_row_group(r, columns=["$ts"]).column(0).to_pandas()
+            value = ts.max() if len(ts) else None
+        else:
+            value = pd.Timestamp(stats.max)
+        if value is not None and (latest is None or value > latest):
+            latest = value
+    return latest
+
+def batches(path, properties=(), batch_size=65536):
+    # Yield the pointfile as a sequence of DataFrames of "$ts", "$id" and the given properties
+    f = pq.ParquetFile(path, read_dictionary=["$id"])
+    for batch in f.iter_batches(batch_size=batch_size, columns=["$ts", "$id"] + list(properties)):
+        yield batch.to_pandas()
+
+def read(path, properties=()):
+    # The whole pointfile as one DataFrame, still only reading the columns needed
+    return pq.read_table(path, columns=["$ts", "$id"] + list(properties), read_dictionary=["$id"]).to_pandas()
+
+def timeout_transitions(path, timeout, batch_size=65536, devices=None):
+    # engine.timeout_transitions() for a Parquet pointfile of any size, yielding transitions a batch at a time
+    return chunked.timeout_transitions(batches(path, (), batch_size), timeout, devices)
+
+def uptime_sums(path, timeout, bin_size, origin=None, by="version", keyframe=0, batch_size=65536, devices=None):
+    # query.version_bin_sums() for a Parquet pointfile, streamed a batch at a time
+    stream = StreamingUptime(timeout, bin_size, origin, by, devices)
+    ups, presents = [], []
+    for df in batches(path, [by], batch_size):
+        up, present = stream.update(df, keyframe=keyframe)
+        ups.append(up)
+        presents.append(present)
+        keyframe = max(0, keyframe - len(df))
+    up, present = stream.bins()
+    ups.append(up)
+    presents.append(present)
+
+    # As the end time is known, the bins run exactly until they cover the last row
+    end = end_time(path)
+    if end is None:
+        return up, present
+    columns = pd.date_range(pd.Timestamp(stream.origin), end, freq=pd.Timedelta(stream.bin_size), inclusive="left")
+    if len(columns) == 0:
+        columns = columns.append(pd.DatetimeIndex([pd.Timestamp(stream.origin)]))
+    # A version first seen in a later batch had no time in the bins finalized before it
+    combine = lambda parts: pd.concat([p.reindex(up.index, fill_value=pd.Timedelta(0)) for p in parts], axis=1)
+    return (combine(ups).reindex(columns=columns, fill_value=pd.Timedelta(0)),
+            combine(presents).reindex(columns=columns, fill_value=pd.Timedelta(0)))
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import tempfile
+    import engine
+    import sample
+    import query
+
+    print("FUNCTIONAL TEST")
+    df = sample.pointfile()
+    path = os.path.join(tempfile.mkdtemp(), "sample.parquet")
+    df.to_parquet(path, row_group_size=5)
+
+    print("End time", end_time(path))
+    up, present = uptime_sums(path, sample.TIMEOUT, sample.BIN_SIZE, batch_size=4)
+    expected_up, expected_present = query.version_bin_sums(df, sample.TIMEOUT, sample.BIN_SIZE)
+
+    # A version that first appears after the first batch: B upgrades to version 3 when it comes back
+    upgraded = df.copy()
+    upgraded.loc[15, "version"] = "3"
+    upgraded_path = os.path.join(os.path.dirname(path), "upgraded.parquet")
+    upgraded.to_parquet(upgraded_path, row_group_size=5)
+    upgraded_up, upgraded_present = uptime_sums(upgraded_path, sample.TIMEOUT, sample.BIN_SIZE, batch_size=8)
+    expected_upgraded = query.version_bin_sums(upgraded, sample.TIMEOUT, sample.BIN_SIZE)
+    print(upgraded_present)
+    transitions = pd.concat(list(timeout_transitions(path, sample.TIMEOUT, batch_size=4)), ignore_index=True)
+    if (end_time(path) == df["$ts"].iloc[-1] and up.equals(expected_up) and present.equals(expected_present)
+            and upgraded_up.equals(expected_upgraded[0]) and upgraded_present.equals(expected_upgraded[1])
+            and transitions.equals(engine.timeout_transitions(df, sample.TIMEOUT))):
+        print("PASSED\n")
+    else:
+        print("FAILED\n", up, "\n", expected_up)
+        sys.exit(-1)
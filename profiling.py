@@ -0,0 +1,140 @@
+# profiling.py
+# Per-stage profiling, built into the queries
+#
+# The queries mark out their logical stages (ffill, merge, timer, eventify, bin split, reduce...) with
+#     with profiling.stage("ffill", rows_in) as s:
+#         ...
+#         s.rows_out = n
+# When no Profile is active stage() hands back one shared do-nothing object, so this costs a function call
+# and an attribute store per stage - nothing per row. To profile, run the query inside a Profile:
+#     with profiling.Profile() as p:
+#         query.version_bin_sums(df, ...)
+#     p.as_dict()   # {"ffill": {"calls": 1, "seconds": ..., "rows_in": ..., "rows_out": ..., "bytes": ...}, ...}
+# or pass callback= to have each stage's record handed over as it finishes (e.g. to a metrics system).
+# With memory=True the bytes allocated at the peak of each stage are measured with tracemalloc, which
+# slows things down, so it is off by default (and "bytes" is None).
+
+import time
+import tracemalloc
+
+_active = None  # The Profile currently recording, if any
+
+
+class _Off:
+    # What stage() returns when nothing is recording
+    rows_out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_OFF = _Off()
+
+
+class _Stage:
+    def __init__(self, profile, name, rows_in):
+        self.profile = profile
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+
+    def __enter__(self):
+        if self.profile.memory:
+            self.memory_start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        nbytes = None
+        if self.profile.memory:
+            nbytes = max(0, tracemalloc.get_traced_memory()[1] - self.memory_start)
+        self.profile.record(self.name, seconds, self.rows_in, self.rows_out, nbytes)
+        return False
+
+
+class Profile:
+    def __init__(self, callback=None, memory=False):
+        self.callback = callback
+        self.memory = memory
+        self.stages = {}    # Stage name -> totals, in the order stages first ran
+        self._outer = None
+        self._started_tracing = False
+
+    def __enter__(self):
+        global _active
+        self._outer = _active
+        _active = self
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = self._outer
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return False
+
+    def record(self, name, seconds, rows_in=None, rows_out=None, nbytes=None):
+        totals = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "rows_in": 0, "rows_out": 0, "bytes": None})
+        totals["calls"] += 1
+        totals["seconds"] += seconds
+        totals["rows_in"] += rows_in or 0
+        totals["rows_out"] += rows_out or 0
+        if nbytes is not None:
+            totals["bytes"] = max(totals["bytes"] or 0, nbytes)
+        if self.callback is not None:
+            self.callback({"stage": name, "seconds": seconds, "rows_in": rows_in, "rows_out": rows_out, "bytes": nbytes})
+
+    def as_dict(self):
+        return {name: dict(totals) for name, totals in self.stages.items()}
+
+    def report(self):
+        total = sum(t["seconds"] for t in self.stages.values()) or 1
+        lines = []
+        for name, t in self.stages.items():
+            lines.append("{:12} {:>9.1f}ms {:>5.1f}% {:>12,} rows in {:>12,} rows out{}".format(
+                name, t["seconds"] * 1000, 100 * t["seconds"] / total, t["rows_in"], t["rows_out"],
+                "" if t["bytes"] is None else " {:>10,.1f} MB".format(t["bytes"] / 1e6)))
+        return "\n".join(lines)
+
+
+def stage(name, rows_in=None):
+    # A context manager timing one stage of whatever Profile is active
+    if _active is None:
+        return _OFF
+    return _Stage(_active, name, rows_in)
+
+def enabled():
+    return _active is not None
+
+
+if __name__ == "__main__":
+    import sys
+    import profiling    # The module the queries use, rather than this script's own copy of it
+    import sample
+    import kernels
+    import query
+
+    print("FUNCTIONAL TEST")
+    df = sample.pointfile()
+    expected = query.version_bin_sums(df, sample.TIMEOUT, sample.BIN_SIZE)
+    records = []
+    with profiling.Profile(callback=records.append, memory=True) as profile:
+        result = query.version_bin_sums(df, sample.TIMEOUT, sample.BIN_SIZE)
+    print(profile.report())
+    stages = profile.as_dict()
+    if (not profiling.enabled() and result[0].equals(expected[0]) and [r["stage"] for r in records] == list(stages)
+            and ({"sweep", "reduce"} if kernels.enabled() else {"sort", "timer", "ffill", "bin split", "reduce"}) <= set(stages)
+            and stages["ids"]["rows_in"] == len(df)
+            and all(t["bytes"] is not None for t in stages.values())):
+        print("PASSED\n")
+    else:
+        print("FAILED\n", stages)
+        sys.exit(-1)
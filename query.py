@@ -0,0 +1,134 @@
+# query.py
+# The canonical query from hard.py: "Uptime by software version, grouped by time"
+#
+# This goes straight from the raw "$ts", "$id", "version" pointfile to the version x bin table, without
+# materialising the "up" transitions that timeout() produces or the per-row frame that
+# percent_of_time_where() builds from them. Every message starts an interval (up to the device's next
+# message) on that device's version; within it the device is up or down from the message until its
+# timeout fires, and then takes its post-timeout state (see engine._message_states). These intervals are
+# split into bins directly, so apart from the result the working memory is a few arrays as long as the input.
+#
+# The denominator is the number of devices on each version during each bin, i.e. the time devices spent
+# present on it. We don't know what happens after the last row, so nothing is counted beyond it.
+
+import numpy as np
+import pandas as pd
+
+import engine
+import kernels
+import profiling
+
+
+def version_bin_sums(df, timeout, bin_size, origin=None, num_bins=None, by="version", devices=None, intervals=None):
+    # Returns (up_time, present_time): DataFrames of Timedeltas indexed by `by` value, with a column per bin
+    # labelled by the bin's start. Bins start at origin (default: the first timestamp, rounded down to bin_size)
+    # and by default carry on until they cover the last row. timeout can be a mapping of $id -> Timedelta.
+    # With an intervals.PropertyIndex each row's value comes from that instead, and df needs no `by` column
+    ts = engine._timestamps(df["$ts"])
+    with profiling.stage("ids", len(ts)) as s:
+        codes, ids = engine._id_codes(df["$id"], devices)
+        if intervals is None:
+            groups, values = pd.factorize(df[by])
+        else:
+            groups, values, by = intervals.lookup(codes, ts, ids), intervals.values, intervals.prop
+        s.rows_out = len(ts)
+    timeout = engine._row_timeouts(timeout, codes, ids)
+    size = pd.Timedelta(bin_size).value
+    origin, num_bins = _layout(ts, size, origin, num_bins)
+    up_time, present_time = _bin_sums(ts, codes, groups, ts[-1] if len(ts) else 0, timeout, origin, size, len(values), num_bins)
+    with profiling.stage("reduce", up_time.size) as s:
+        result = _frames(up_time, present_time, pd.Index(values, name=by), origin, size)
+        s.rows_out = up_time.size
+    return result
+
+def _layout(ts, size, origin, num_bins):
+    # Default bins start at the first timestamp (rounded down to the bin size) and cover the last row
+    if origin is None:
+        origin = ts[0] - ts[0] % size if len(ts) else 0
+    else:
+        origin = pd.Timestamp(origin).value
+    if num_bins is None:
+        num_bins = max(1, -(-(ts[-1] - origin) // size)) if len(ts) else 1
+    return origin, num_bins
+
+def _frames(up_time, present_time, index, origin, size):
+    columns = pd.DatetimeIndex(origin + np.arange(up_time.shape[1]) * size)
+    return (pd.DataFrame(up_time.view("timedelta64[ns]"), index=index, columns=columns),
+            pd.DataFrame(present_time.view("timedelta64[ns]"), index=index, columns=columns))
+
+def _bin_sums(ts, codes, groups, end, timeout, origin, size, num_groups, num_bins):
+    # The arrays behind version_bin_sums(). ts, codes and groups (-1 where the row has no value) are in row
+    # order; end is the time of the last row of the whole pointfile. timeout is in ns, either one value or
+    # one per row
+    if kernels.enabled():
+        with profiling.stage("sweep", len(ts)) as s:
+            up_time, present_time = kernels.bin_sums(ts, codes, groups, end, timeout, origin, size, num_groups, num_bins)
+            s.rows_out = up_time.size
+        return up_time, present_time
+
+    up_time = np.zeros((num_groups, num_bins), dtype=np.int64)
+    present_time = np.zeros((num_groups, num_bins), dtype=np.int64)
+    if len(ts) == 0:
+        return up_time, present_time
+
+    n = len(ts)
+    with profiling.stage("sort", n) as s:
+        order, first, last = engine._device_order(codes)
+        ts = ts[order]
+        s.rows_out = n
+    with profiling.stage("timer", n) as s:
+        up, deadline, expires, after = engine._message_states(ts, first, last, timeout if np.ndim(timeout) == 0 else timeout[order])
+        s.rows_out = n
+
+    with profiling.stage("ffill", n) as s:
+        g = groups[order].astype(float)
+        g[g < 0] = np.nan
+        g = engine._ffill(g, first)
+        on = ~np.isnan(g)   # Rows before a device's first version don't count towards any version
+        g = np.where(on, g, 0).astype(np.int64)
+        s.rows_out = int(on.sum())
+
+    with profiling.stage("bin split", n) as s:
+        nxt = np.empty_like(ts)
+        nxt[:-1] = ts[1:]
+        nxt[last] = end
+        _split(up_time, present_time, g[on], ts[on], nxt[on], up[on], deadline[on], expires[on], after[on], origin, size)
+        s.rows_out = up_time.size
+    return up_time, present_time
+
+def _split(up_time, present_time, g, ts, nxt, up, deadline, expires, after, origin, size):
+    # Add each message's interval [ts, nxt) into group g's bins: all of it to present time, and to up time
+    # the part before its timeout fires if it brought the device up, and the part after if that is up
+    fired = np.where(expires, np.minimum(deadline, nxt), nxt)
+    engine._add_to_bins(present_time, g, ts, nxt, np.ones(len(g), dtype=np.int64), origin, size)
+    engine._add_to_bins(up_time, g, ts, fired, up.astype(np.int64), origin, size)
+    engine._add_to_bins(up_time, g, fired, nxt, after.astype(np.int64), origin, size)
+
+def uptime_percent(up_time, present_time):
+    # Percentage of the devices on each version that were up, per bin (NaN where there were none)
+    return 100 * (up_time / present_time)
+
+def uptime_by_version(df, timeout, bin_size, origin=None, num_bins=None, by="version", devices=None):
+    return uptime_percent(*version_bin_sums(df, timeout, bin_size, origin, num_bins, by, devices))
+
+
+if __name__ == "__main__":
+    import sys
+    import sample
+    from streaming import StreamingUptime
+
+    print("FUNCTIONAL TEST")
+    df = sample.pointfile()
+    result = uptime_by_version(df, sample.TIMEOUT, sample.BIN_SIZE)
+    print(result.round(1).to_string())
+
+    # Must agree with streaming the same data
+    up, present = version_bin_sums(df, sample.TIMEOUT, sample.BIN_SIZE)
+    stream = StreamingUptime(sample.TIMEOUT, sample.BIN_SIZE)
+    done_up, done_present = stream.update(df)
+    open_up, open_present = stream.bins()
+    if pd.concat([done_up, open_up], axis=1).equals(up) and pd.concat([done_present, open_present], axis=1).equals(present):
+        print("PASSED\n")
+    else:
+        print("FAILED")
+        sys.exit(-1)
@@ -0,0 +1,251 @@
+# rollup.py
+# Multi-resolution rollups of the up-time and present-time sums
+#
+# Up-time and present-time simply add up, so the sums for an hour are the sums of its twelve 5-minute bins.
+# A Rollup holds the (group x bin) sums at a base resolution, as produced by query.version_bin_sums() or
+# StreamingUptime, plus pre-summed coarser levels (by default hourly and daily). Any coarser bin size that
+# is a multiple of the base is answered by summing the finest stored level that divides it, so e.g. 90 days
+# at daily resolution reads 90 numbers per version rather than going back to the events.
+#
+# Bins at every resolution are aligned to multiples of their size from the epoch (shifted by the base
+# origin's offset from the base grid, if it isn't on it). Coarse bins only partly covered by the base bins
+# just have the sums of the part that is covered.
+#
+# Every level is held in arrays with room to spare, which double when they fill up, so extend() only writes
+# the new base bins and re-sums the coarse bins they fall in: a bin at a time, it costs the same however
+# much history is held.
+
+import numpy as np
+import pandas as pd
+
+import query
+
+
+def _grow(buffer, rows, cols):
+    # buffer if it has room for rows x cols, otherwise a copy with at least double the room where it is short
+    if rows <= buffer.shape[0] and cols <= buffer.shape[1]:
+        return buffer
+    shape = tuple(n if n <= have else max(n, 2 * have) for n, have in zip((rows, cols), buffer.shape))
+    grown = np.zeros(shape, dtype=buffer.dtype)
+    grown[:buffer.shape[0], :buffer.shape[1]] = buffer
+    return grown
+
+
+class Rollup:
+    def __init__(self, base, origin, index=(), levels=("1h", "1D")):
+        self.base = pd.Timedelta(base).value
+        self.offset = pd.Timestamp(origin).value % self.base    # Where bin edges sit relative to the epoch
+        self.origin = pd.Timestamp(origin).value  # Start of the first base bin
+        self.index = pd.Index(index)
+        self.up = np.zeros((len(self.index), 0), dtype=np.int64)
+        self.present = np.zeros((len(self.index), 0), dtype=np.int64)
+        self.levels = {}    # Bin size -> (start of first bin, up, present)
+        self._buffers = {self.base: [self.up, self.present]}    # Bin size -> the arrays the above are views of
+        for level in levels:
+            size = pd.Timedelta(level).value
+            if size % self.base or size == self.base:
+                raise ValueError("Rollup levels must be multiples of the base bin size")
+            start = self._floor(self.origin, size)
+            self.levels[size] = (start, self.up[:, :0], self.present[:, :0])
+            self._buffers[size] = [self.up[:, :0], self.present[:, :0]]
+
+    @classmethod
+    def from_sums(cls, up_time, present_time, base=None, levels=("1h", "1D")):
+        # From the (up_time, present_time) DataFrames of query.version_bin_sums() or StreamingUptime
+        if base is None:
+            if up_time.shape[1] < 2:
+                raise ValueError("Give the base bin size when there are fewer than two bins")
+            base = up_time.columns[1] - up_time.columns[0]
+        return cls._from_frames(up_time, present_time, base, levels)
+
+    @classmethod
+    def _from_frames(cls, up_time, present_time, base, levels):
+        rollup = cls(base, up_time.columns[0], up_time.index, levels)
+        rollup.extend(up_time, present_time)
+        return rollup
+
+    @classmethod
+    def build(cls, df, timeout, base="5min", by="version", origin=None, levels=("1h", "1D"), devices=None):
+        # Roll up a pointfile from scratch
+        up_time, present_time = query.version_bin_sums(df, timeout, base, origin, by=by, devices=devices)
+        return cls._from_frames(up_time, present_time, base, levels)
+
+    def _floor(self, t, size):
+        return t - (t - self.offset) % size
+
+    def _ns(self, frame):
+        if not frame.index.equals(self.index):
+            frame = frame.reindex(index=self.index, fill_value=pd.Timedelta(0))
+        return frame.to_numpy(dtype="timedelta64[ns]").view(np.int64)
+
+    def extend(self, up_time, present_time):
+        # Add base bins following on from those already held (e.g. bins just finalized by StreamingUptime)
+        if up_time.shape[1] == 0:
+            return
+        start = up_time.columns[0].value
+        count = self.up.shape[1]
+        if start != self.origin + count * self.base:
+            raise ValueError("Bins must carry on from the end of the rollup, at " + str(pd.Timestamp(self.origin + count * self.base)))
+        if len(self.index) == 0:
+            self.index = up_time.index[:0]  # So the index takes the name and dtype of the groups
+        if not up_time.index.equals(self.index):
+            new_groups = up_time.index.difference(self.index, sort=False)
+            if len(new_groups):
+                self.index = self.index.append(new_groups)
+        self.up, self.present = self._write(self.base, count, self._ns(up_time), self._ns(present_time))
+        self._roll(start)
+
+    def _write(self, size, col, up, present):
+        # Put bins into level `size` (or the base) from its bin number col on, and return views of all its bins
+        buffers = self._buffers[size]
+        rows, cols = len(self.index), col + up.shape[1]
+        for i, bins in enumerate((up, present)):
+            buffers[i] = _grow(buffers[i], rows, cols)
+            buffers[i][:len(bins), col:cols] = bins
+        return buffers[0][:rows, :cols], buffers[1][:rows, :cols]
+
+    def _divisor(self, size, levels):
+        # The coarsest of the base and the given levels that divides size, as (bin size, start, up, present)
+        finer = (self.base, self.origin, self.up, self.present)
+        for level in sorted(levels):
+            if size % level == 0:
+                level_start, up, present = self.levels[level]
+                finer = (level, level_start, up, present)
+        return finer
+
+    def _roll(self, changed):
+        # Re-sum each level's bins from the one containing time `changed` onwards, from the coarsest finer level
+        # that divides it (e.g. 15min from 5min rather than from 10min)
+        done = []
+        for size in sorted(self.levels):
+            start = self.levels[size][0]
+            k = max(0, (changed - start) // size)
+            edge = start + k * size
+            finer_size, finer_start, finer_up, finer_present = self._divisor(size, done)
+            j = max(0, (edge - finer_start) // finer_size)
+            tail = (finer_size, finer_start + j * finer_size, finer_up[:, j:], finer_present[:, j:])
+            up, present = self._write(size, k, *self._sum(tail, edge, size))
+            self.levels[size] = (start, up, present)
+            done.append(size)
+
+    def _sum(self, finer, start, size):
+        # Sum a finer level's bins into bins of `size` starting at `start` (which is on the finer level's grid)
+        finer_size, finer_start, up, present = finer
+        factor = size // finer_size
+        lead = (finer_start - start) // finer_size
+        end = finer_start + up.shape[1] * finer_size
+        num_bins = max(1, -(-(end - start) // size))
+        trail = num_bins * factor - lead - up.shape[1]
+        shape = (len(up), num_bins, factor)
+        pad = lambda a: np.pad(a, ((0, 0), (lead, trail))).reshape(shape).sum(axis=2)
+        return pad(up), pad(present)
+
+    def sums(self, bin_size, start=None, stop=None):
+        # (up_time, present_time) DataFrames at bin_size, optionally just the bins from start until stop
+        size = pd.Timedelta(bin_size).value
+        if size % self.base:
+            raise ValueError("Bin size must be a multiple of the base bin size, " + str(pd.Timedelta(self.base)))
+        finer_size, finer_start, up, present = self._divisor(size, self.levels)
+        first = self._floor(finer_start, size)
+        if (start is not None or stop is not None) and up.shape[1]:
+            # Only the finer bins that the bins asked for cover are summed
+            end = finer_start + up.shape[1] * finer_size
+            lo, hi = 0, -(-(end - first) // size)
+            if start is not None:
+                lo = max(lo, (pd.Timestamp(start).value - first) // size)
+            if stop is not None:
+                hi = min(hi, -(-(pd.Timestamp(stop).value - first) // size))
+            if lo >= hi:
+                return query._frames(up[:, :0], present[:, :0], self.index, first, size)
+            first += lo * size
+            j = max(0, (first - finer_start) // finer_size)
+            k = -(-(first + (hi - lo) * size - finer_start) // finer_size)
+            finer_start, up, present = finer_start + j * finer_size, up[:, j:k], present[:, j:k]
+        up, present = self._sum((finer_size, finer_start, up, present), first, size)
+        return query._frames(up, present, self.index, first, size)
+
+    def uptime_percent(self, bin_size, start=None, stop=None):
+        return query.uptime_percent(*self.sums(bin_size, start, stop))
+
+    def save(self, path):
+        # The index is saved as strings, with its name and dtype so that load() gives back the same index
+        name = [] if self.index.name is None else [str(self.index.name)]
+        np.savez(path, base=self.base, origin=self.origin, index=np.array(self.index.astype(str), dtype=str),
+                 index_name=np.array(name, dtype=str), index_dtype=str(self.index.dtype), up=self.up,
+                 present=self.present, levels=np.array(sorted(self.levels), dtype=np.int64))
+
+    @classmethod
+    def load(cls, path):
+        f = np.load(path, allow_pickle=False)
+        index = pd.Index(f["index"]).astype(str(f["index_dtype"])).rename(f["index_name"][0] if len(f["index_name"]) else None)
+        rollup = cls(int(f["base"]), int(f["origin"]), index, [pd.Timedelta(int(size)) for size in f["levels"]])
+        rollup.up, rollup.present = rollup._write(rollup.base, 0, f["up"], f["present"])
+        rollup._roll(rollup.origin)
+        return rollup
+
+
+if __name__ == "__main__":
+    import sys
+    import sample
+
+    print("FUNCTIONAL TEST")
+    df = sample.pointfile()
+    rollup = Rollup.build(df, sample.TIMEOUT, "1min", levels=("5min", "15min"))
+    ok = True
+    for size in ("1min", "5min", "10min", "15min", "30min", "1h"):
+        up, present = rollup.sums(size)
+        origin = df["$ts"].iloc[0].floor(size)
+        expected_up, expected_present = query.version_bin_sums(df, sample.TIMEOUT, size, origin=origin)
+        ok &= up.equals(expected_up) and present.equals(expected_present)
+    print(rollup.uptime_percent("10min").round(1))
+
+    # Levels that aren't multiples of each other are each summed from one that divides them
+    uneven = Rollup.build(df, sample.TIMEOUT, "5min", levels=("10min", "15min"))
+    for size in ("10min", "15min", "30min"):
+        expected_up, expected_present = query.version_bin_sums(df, sample.TIMEOUT, size, origin=df["$ts"].iloc[0].floor(size))
+        up, present = uneven.sums(size)
+        ok &= up.equals(expected_up) and present.equals(expected_present)
+
+    # Built up a bin at a time, and saved and loaded (with versions that aren't strings)
+    import os
+    import tempfile
+    numbered = df.assign(version=df["version"].astype("Int64"))
+    rollup = Rollup.build(numbered, sample.TIMEOUT, "1min", levels=("5min", "15min"))
+    whole_up, whole_present = query.version_bin_sums(numbered, sample.TIMEOUT, "1min")
+    growing = Rollup("1min", whole_up.columns[0], levels=("5min", "15min"))
+    for b in range(whole_up.shape[1]):
+        growing.extend(whole_up.iloc[:, b:b + 1], whole_present.iloc[:, b:b + 1])
+    path = os.path.join(tempfile.mkdtemp(), "rollup.npz")
+    growing.save(path)
+    loaded = Rollup.load(path)
+    ok &= loaded.index.equals(growing.index) and loaded.index.dtype == growing.index.dtype and loaded.index.name == "version"
+    for size in ("15min", "1h"):
+        ok &= all(a.equals(b) for a, b in zip(growing.sums(size), rollup.sums(size)))
+        ok &= all(a.equals(b) and a.index.name == b.index.name for a, b in zip(loaded.sums(size), rollup.sums(size)))
+
+    # Versions only passed in from the first bin they are present in, so they join part way through
+    sparse = Rollup("1min", whole_up.columns[0], levels=("5min", "15min"))
+    for b in range(whole_up.shape[1]):
+        seen = whole_present.index[whole_present.iloc[:, :b + 1].to_numpy().any(axis=1)]
+        sparse.extend(whole_up.loc[seen].iloc[:, b:b + 1], whole_present.loc[seen].iloc[:, b:b + 1])
+    for size in ("5min", "15min", "30min"):
+        ok &= all(a.reindex(b.index).equals(b) for a, b in zip(sparse.sums(size), rollup.sums(size)))
+
+    # Just some of the bins: the same as those bins of all of them
+    start = whole_up.columns[0]
+    for size in ("1min", "5min", "15min", "30min"):
+        up, present = rollup.sums(size)
+        for lo, hi in ((None, "7min"), ("7min", "22min"), ("14min", None), ("31min", "29min"), ("2h", None)):
+            lo, hi = (None if lo is None else start + pd.Timedelta(lo)), (None if hi is None else start + pd.Timedelta(hi))
+            keep = np.ones(up.shape[1], dtype=bool)
+            if lo is not None:
+                keep &= up.columns + pd.Timedelta(size) > lo
+            if hi is not None:
+                keep &= up.columns < hi
+            part = rollup.sums(size, lo, hi)
+            ok &= part[0].equals(up.loc[:, keep]) and part[1].equals(present.loc[:, keep])
+    if ok:
+        print("PASSED\n")
+    else:
+        print("FAILED")
+        sys.exit(-1)
@@ -0,0 +1,146 @@
+# sampling.py
+# Approximate uptime by version from a sample of the devices, with confidence intervals
+#
+# For an overview of a large fleet, uptime per version doesn't need to be exact. Devices are sampled by a
+# hash of their id, so the same devices are chosen in every pointfile and every query (and a larger rate
+# chooses a superset of a smaller one's devices). The normal engine then runs on just their rows, and the
+# up-time and present-time totals are scaled up by 1/rate.
+#
+# Uptime percent is a ratio of two sampled totals, so its error comes from how much the sampled devices'
+# own uptime varies around it. For each bin and version, with y and x each sampled device's up-time and
+# present-time on that version, R = sum(y) / sum(x) and (for a Bernoulli sample at rate p)
+#     Var(R) ~= (1 - p) * sum((y - R x)^2) / sum(x)^2
+# which needs each device's own totals, so the engine is run grouped by (device, version) pairs and those
+# are reduced to versions here. Uptime is usually close to 100%, where R +- z * sqrt(Var(R)) is too narrow
+# (often zero width, when no sampled device was down), so the interval is a Wilson score interval. Its
+# sample size is the number of whole devices the sampled present-time amounts to, or fewer if Var(R) says
+# the devices vary more than that many would. (The larger size that Var(R) alone gives is too narrow: down
+# time comes from a few devices, so the variance is itself poorly estimated, and only about 85% of bins'
+# exact uptime fell inside the 95% interval.) On synthetic fleets at rates from 1% to 10%, 96-100% of bins
+# are covered. With rate=1 it is exact, with zero width. Lower rates trade accuracy for latency roughly in
+# proportion.
+
+import statistics
+
+import numpy as np
+import pandas as pd
+
+import engine
+import profiling
+import query
+
+
+def sampled(ids, rate, seed=0):
+    # Boolean mask of the rows whose device id falls in the sample
+    key = "{:016d}".format(seed)[-16:]
+    if isinstance(ids.dtype, pd.CategoricalDtype):  # Only the categories need hashing
+        codes, uniques = ids.cat.codes.to_numpy(), ids.cat.categories.to_numpy()
+    else:
+        codes, uniques = pd.factorize(ids)
+    hashes = pd.util.hash_array(np.asarray(uniques, dtype=object), hash_key=key)
+    chosen = np.append((hashes >> np.uint64(11)) < np.uint64(int(rate * 2 ** 53)), False)
+    return chosen[codes]
+
+def sample(df, rate, seed=0):
+    # Just the rows of the sampled devices, e.g. to run percent.percent_of_time_where() or any engine on
+    return df[sampled(df["$id"], rate, seed)]
+
+def _sums(df, timeout, bin_size, rate, origin, num_bins, by, seed, devices):
+    # Per version and bin: sampled up-time and present-time totals, and sum((y - R x)^2) over the sampled devices
+    ts = engine._timestamps(df["$ts"])
+    size = pd.Timedelta(bin_size).value
+    origin, num_bins = query._layout(ts, size, origin, num_bins)   # Bins as for the whole fleet
+    end = ts[-1] if len(ts) else 0
+    with profiling.stage("sample", len(ts)) as s:
+        keep = sampled(df["$id"], rate, seed)
+        ts = ts[keep]
+        codes, ids = engine._id_codes(df["$id"][keep], devices)
+        groups, values = pd.factorize(df[by][keep])
+        on = groups >= 0    # Rows without a value carry the device's last one, as usual
+        pairs = np.full(len(ts), -1, dtype=np.int64)
+        pairs[on], pair_values = pd.factorize(codes[on].astype(np.int64) * len(values) + groups[on])
+        pair_group = pair_values % max(1, len(values))
+        s.rows_out = len(ts)
+
+    timeout = engine._row_timeouts(timeout, codes, ids)
+    y, x = query._bin_sums(ts, codes, pairs, end, timeout, origin, size, len(pair_values), num_bins)
+
+    with profiling.stage("reduce", y.size) as s:
+        up_time = np.zeros((len(values), num_bins), dtype=np.int64)
+        present_time = np.zeros((len(values), num_bins), dtype=np.int64)
+        np.add.at(up_time, pair_group, y)
+        np.add.at(present_time, pair_group, x)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ratio = up_time / present_time
+        residuals = np.zeros((len(values), num_bins))
+        np.add.at(residuals, pair_group, (y - np.nan_to_num(ratio)[pair_group] * x) ** 2)
+        squares = np.zeros((len(values), num_bins))
+        np.add.at(squares, pair_group, x.astype(float) ** 2)
+        s.rows_out = up_time.size
+    return up_time, present_time, residuals, squares, pd.Index(values, name=by), origin, size
+
+def version_bin_sums(df, timeout, bin_size, rate=0.01, origin=None, num_bins=None, by="version", seed=0, devices=None):
+    # Estimates of query.version_bin_sums() for the whole fleet, from the sampled devices
+    up_time, present_time, _, _, index, origin, size = _sums(df, timeout, bin_size, rate, origin, num_bins, by, seed, devices)
+    return query._frames(np.round(up_time / rate).astype(np.int64), np.round(present_time / rate).astype(np.int64), index, origin, size)
+
+def uptime_by_version(df, timeout, bin_size, rate=0.01, origin=None, num_bins=None, by="version", seed=0, confidence=0.95, devices=None):
+    # (percent, low, high): estimated uptime percent per version and bin, and its confidence interval
+    up_time, present_time, residuals, squares, index, origin, size = _sums(df, timeout, bin_size, rate, origin, num_bins, by, seed, devices)
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ratio = up_time / present_time
+        variance = (1 - rate) * residuals / present_time.astype(float) ** 2
+
+        # A Wilson score interval, so that it stays open near 0% and 100%, for the number of whole devices the
+        # sample amounts to, or the smaller sample size that has the variance
+        whole_devices = present_time.astype(float) ** 2 / squares / (1 - rate)
+        n = np.minimum(np.where(variance > 0, ratio * (1 - ratio) / variance, np.inf), whole_devices)
+        z2 = z * z / n
+        centre = (ratio + z2 / 2) / (1 + z2)
+        half = np.sqrt(z2 * ratio * (1 - ratio) + z2 * z2 / 4) / (1 + z2)
+        low, high = centre - half, centre + half
+    columns = pd.DatetimeIndex(origin + np.arange(up_time.shape[1]) * size)
+    frame = lambda a: pd.DataFrame(100 * a, index=index, columns=columns)
+    return frame(ratio), frame(np.clip(low, 0, 1)), frame(np.clip(high, 0, 1))
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import benchmark
+    import sample as sample_data
+
+    print("FUNCTIONAL TEST")
+    df = sample_data.pointfile()
+    ok = True
+    # Everything sampled is exact
+    up, present = version_bin_sums(df, sample_data.TIMEOUT, sample_data.BIN_SIZE, rate=1)
+    expected_up, expected_present = query.version_bin_sums(df, sample_data.TIMEOUT, sample_data.BIN_SIZE)
+    ok &= up.equals(expected_up) and present.equals(expected_present)
+    percent, low, high = uptime_by_version(df, sample_data.TIMEOUT, sample_data.BIN_SIZE, rate=1)
+    ok &= percent.equals(query.uptime_percent(expected_up, expected_present)) and low.equals(percent) and high.equals(percent)
+
+    # A large fleet: the exact uptime should mostly fall within the intervals, and the sample is repeatable
+    fleet = benchmark.fleet(50_000, span=pd.Timedelta(hours=2))
+    fleet["$id"] = fleet["$id"].astype("category")
+    t = time.time()
+    exact = query.uptime_by_version(fleet, "15min", "10min")
+    print("exact      {:6.0f}ms".format((time.time() - t) * 1000))
+    for rate in (0.01, 0.1):
+        t = time.time()
+        percent, low, high = uptime_by_version(fleet, "15min", "10min", rate=rate)
+        took = time.time() - t
+        exact_here = exact.reindex(percent.index)
+        known = exact_here.notna() & percent.notna()
+        covered = ((exact_here >= low - 1e-9) & (exact_here <= high + 1e-9))[known].sum().sum() / known.sum().sum()
+        print("rate {:4} {:6.0f}ms  worst error {:5.2f}%  median interval width {:5.2f}%  {:.0%} of bins covered".format(
+            rate, took * 1000, (percent - exact_here)[known].abs().max().max(), (high - low)[known].stack().median(), covered))
+        ok &= covered >= 0.9
+    ok &= uptime_by_version(fleet, "15min", "10min", rate=0.01)[0].equals(uptime_by_version(fleet, "15min", "10min", rate=0.01)[0])
+    ok &= sampled(fleet["$id"], 0.01).sum() <= sampled(fleet["$id"], 0.1).sum() and not (sampled(fleet["$id"], 0.01) & ~sampled(fleet["$id"], 0.1)).any()
+    if ok:
+        print("PASSED\n")
+    else:
+        print("FAILED")
+        sys.exit(-1)
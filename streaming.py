@@ -0,0 +1,330 @@
+# streaming.py
+# "Uptime by version, grouped by time" computed incrementally, one pointfile (or chunk) at a time
+#
+# A StreamingUptime carries, per device: when its last message was, whether that message brought it up,
+# what happens when that message's timeout fires, and its current version. Per version it carries how many
+# devices are up and how many are present, and the partly-filled bins that event time hasn't passed yet.
+# So each update only costs as much as its new rows (plus any timeouts that fire), not the whole history.
+#
+# The up/down rules are exactly those of timeout.timeout() (see engine._message_states).
+#
+# Keyframes: the first rows of each pointfile repeat the state of every device. For devices we are already
+# tracking this is state we already hold, so those rows are skipped. Rows older than the event time
+# already reached can only be keyframe rows, so they are treated the same way. For a device we haven't seen
+# before, its keyframe row is its first row (which, as in timeout(), leaves it down).
+#
+# Snapshots: snapshot() writes the whole state to a directory as one .npy file per array (the device
+# dictionary, the per-device and per-group arrays, the open bins) plus a small state.json of the scalars
+# and group values. restore() memory-maps the arrays copy-on-write, so a worker resumes a stream of any
+# number of devices without replaying history or parsing a keyframe; pages are only read as they are used.
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import engine
+import profiling
+import query
+from devices import DeviceDictionary
+
+
+class StreamingUptime:
+    def __init__(self, timeout, bin_size, origin=None, by="version", devices=None):
+        self.timeout = pd.Timedelta(timeout).value
+        self.bin_size = pd.Timedelta(bin_size).value
+        self.origin = None if origin is None else pd.Timestamp(origin).value
+        self.by = by
+        self.event_time = None  # Latest timestamp seen on any device
+
+        # Per device, indexed by code in the (possibly shared) device dictionary
+        self.devices = devices if devices is not None else DeviceDictionary()
+        self.tracked = np.zeros(0, dtype=bool)     # Whether we have had any rows for the device
+        self.last_seen = np.zeros(0, dtype=np.int64)
+        self.up = np.zeros(0, dtype=bool)          # State from the last message on
+        self.after = np.zeros(0, dtype=bool)       # State once the last message's timeout has fired
+        self.expired = np.zeros(0, dtype=bool)     # Whether it has fired yet
+        self.group = np.zeros(0, dtype=np.int64)   # Code of the device's `by` value, -1 if not known yet
+
+        # Per group (value of `by`), indexed by group code
+        self.groups = {}
+        self.up_count = np.zeros(0, dtype=np.int64)
+        self.present_count = np.zeros(0, dtype=np.int64)
+
+        # Bins that event time hasn't moved past yet, as (groups, bins) arrays of nanoseconds
+        self.open_from = 0  # Bin number of the first open bin
+        self.open_up = np.zeros((0, 0), dtype=np.int64)
+        self.open_present = np.zeros((0, 0), dtype=np.int64)
+
+    _ARRAYS = ("tracked", "last_seen", "up", "after", "expired", "group", "up_count", "present_count", "open_up", "open_present")
+
+    def snapshot(self, path):
+        # Each file is written under a temporary name and renamed over the old one, never truncated in place, so
+        # a stream can snapshot into the directory it was restored from (whose files it may still have mapped)
+        os.makedirs(path, exist_ok=True)
+        state_path = os.path.join(path, "state.json")
+        if os.path.exists(state_path):
+            os.remove(state_path)   # Until it is written again, the snapshot isn't whole
+
+        def write(name, save):
+            temporary = os.path.join(path, name + ".tmp.npy")
+            save(temporary)
+            os.replace(temporary, os.path.join(path, name + ".npy"))
+        write("devices", self.devices.save)
+        for name in self._ARRAYS:
+            write(name, lambda p: np.save(p, getattr(self, name), allow_pickle=False))
+        optional = lambda t: None if t is None else int(t)
+        state = {"timeout": self.timeout, "bin_size": self.bin_size, "origin": optional(self.origin), "by": self.by,
+                 "event_time": optional(self.event_time), "open_from": int(self.open_from),
+                 "groups": [g.item() if hasattr(g, "item") else g for g in self.groups]}
+        with open(state_path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(state_path + ".tmp", state_path)    # Last, so its presence means the snapshot is whole
+
+    @classmethod
+    def restore(cls, path, mmap_mode="c"):
+        with open(os.path.join(path, "state.json")) as f:
+            state = json.load(f)
+        devices = DeviceDictionary.load(os.path.join(path, "devices.npy"), mmap_mode)
+        stream = cls(pd.Timedelta(state["timeout"]), pd.Timedelta(state["bin_size"]), state["origin"], state["by"], devices)
+        stream.event_time = state["event_time"]
+        stream.open_from = state["open_from"]
+        stream.groups = {g: i for i, g in enumerate(state["groups"])}
+        for name in cls._ARRAYS:
+            setattr(stream, name, np.load(os.path.join(path, name + ".npy"), mmap_mode, allow_pickle=False))
+        return stream
+
+    def _codes(self, values, mapping):
+        # Map `by` values to dense codes, giving new values the next free code. NaN maps to -1
+        codes, uniques = pd.factorize(values)
+        lookup = np.array([mapping.setdefault(u, len(mapping)) for u in uniques] + [-1], dtype=np.int64)
+        return lookup[codes]
+
+    def _grow(self):
+        n = len(self.devices) - len(self.last_seen)
+        if n > 0:
+            self.tracked = np.concatenate([self.tracked, np.zeros(n, dtype=bool)])
+            self.last_seen = np.concatenate([self.last_seen, np.zeros(n, dtype=np.int64)])
+            self.up = np.concatenate([self.up, np.zeros(n, dtype=bool)])
+            self.after = np.concatenate([self.after, np.zeros(n, dtype=bool)])
+            self.expired = np.concatenate([self.expired, np.ones(n, dtype=bool)])
+            self.group = np.concatenate([self.group, np.full(n, -1, dtype=np.int64)])
+        g = len(self.groups) - len(self.up_count)
+        if g > 0:
+            self.up_count = np.concatenate([self.up_count, np.zeros(g, dtype=np.int64)])
+            self.present_count = np.concatenate([self.present_count, np.zeros(g, dtype=np.int64)])
+            pad = np.zeros((g, self.open_up.shape[1]), dtype=np.int64)
+            self.open_up = np.concatenate([self.open_up, pad])
+            self.open_present = np.concatenate([self.open_present, pad])
+
+    def update(self, df, keyframe=0):
+        # Feed the next time-ordered chunk of messages. The first `keyframe` rows are the pointfile's keyframe.
+        # Returns (up_time, present_time) for the bins that are now finalized (see bins())
+        if len(df) == 0:
+            return self._finalize()
+        ts = engine._timestamps(df["$ts"])
+        with profiling.stage("ids", len(ts)) as s:
+            codes = self.devices.encode(df["$id"]).astype(np.int64)
+            groups = self._codes(df[self.by], self.groups)
+            self._grow()
+            s.rows_out = len(ts)
+        if self.origin is None:
+            self.origin = ts[0] - ts[0] % self.bin_size
+        if self.event_time is None:
+            self.event_time = ts[0]
+        horizon = max(self.event_time, ts[-1])
+
+        replay = self.tracked[codes]
+        replay &= (np.arange(len(ts)) < keyframe) | (ts < self.event_time)
+        if replay.any():
+            ts, codes, groups = ts[~replay], codes[~replay], groups[~replay]
+
+        changes = []    # (time, group, change in up count, change in present count)
+        with profiling.stage("timer", len(ts)) as s:
+            if len(ts):
+                order, first, last = engine._device_order(codes)
+                ts, codes, groups = ts[order], codes[order], groups[order]
+                seen = first & self.tracked[codes]  # First row in this chunk of a device we were already tracking
+
+                # Carry each device's last message into the state machine as if it were the previous row
+                prev = np.empty_like(ts)
+                prev[1:] = ts[:-1]
+                prev[first] = self.last_seen[codes[first]]
+                new = first & ~seen
+                up = ~new & (ts - prev <= 2 * self.timeout)
+                after = new | (ts == prev)
+                deadline = ts + self.timeout
+                nxt = np.empty_like(ts)
+                nxt[:-1] = ts[1:]
+                expires = ~last & (nxt > deadline)
+
+                g = groups.astype(float)
+                g[g < 0] = np.nan
+                carried = seen & np.isnan(g)
+                g[carried] = self.group[codes[carried]]
+                g[g < 0] = np.nan
+                g = engine._ffill(g, first)
+                g = np.where(np.isnan(g), -1, g).astype(np.int64)
+
+                # Timeouts still pending from earlier chunks fire if they come before the device's next message
+                c = codes[seen]
+                fires = ~self.expired[c] & (self.last_seen[c] + self.timeout < ts[seen])
+                changes.append((self.last_seen[c[fires]] + self.timeout, self.group[c[fires]],
+                    self.after[c[fires]].astype(np.int64) - self.up[c[fires]], np.zeros(fires.sum(), dtype=np.int64)))
+
+                # State just before each message
+                before_up = np.empty_like(up)
+                before_up[1:] = np.where(expires[:-1], after[:-1], up[:-1])
+                before_up[seen] = np.where(self.expired[c] | fires, self.after[c], self.up[c])
+                before_group = np.empty_like(g)
+                before_group[1:] = g[:-1]
+                before_group[seen] = self.group[codes[seen]]
+                before_present = ~new
+
+                changes.append((ts, before_group, -(before_up & before_present).astype(np.int64), -before_present.astype(np.int64)))
+                changes.append((ts, g, up.astype(np.int64), np.ones(len(ts), dtype=np.int64)))
+                changes.append((deadline[expires], g[expires], after[expires].astype(np.int64) - up[expires], np.zeros(expires.sum(), dtype=np.int64)))
+
+                # Remember each device's last message (its timeout is still pending)
+                c = codes[last]
+                self.last_seen[c] = ts[last]
+                self.up[c] = up[last]
+                self.after[c] = after[last]
+                self.expired[c] = False
+                self.group[c] = g[last]
+                self.tracked[c] = True
+
+            s.rows_out = len(ts)
+
+        # Pending timeouts that event time has now passed (a message at exactly the deadline would still beat it)
+        pending = np.flatnonzero(~self.expired & (self.last_seen + self.timeout < horizon))
+        changes.append((self.last_seen[pending] + self.timeout, self.group[pending],
+            self.after[pending].astype(np.int64) - self.up[pending], np.zeros(len(pending), dtype=np.int64)))
+        self.expired[pending] = True
+
+        with profiling.stage("bin split", sum(len(c[0]) for c in changes)) as s:
+            self._sweep(changes, horizon)
+            s.rows_out = self.open_up.size
+        self.event_time = horizon
+        with profiling.stage("reduce", self.open_up.size) as s:
+            result = self._finalize()
+            s.rows_out = result[0].size
+        return result
+
+    def _sweep(self, changes, horizon):
+        # Between changes the number of up and present devices in each group is constant, so each group's
+        # up-time and present-time is just those counts times the length of each gap, split into bins
+        times, groups, d_up, d_present = (np.concatenate(c) for c in zip(*changes))
+        keep = groups >= 0
+        times, groups, d_up, d_present = times[keep], groups[keep], d_up[keep], d_present[keep]
+        times = np.maximum(times, self.event_time)  # A new device's keyframe row (or its timeout) before event time counts from event time
+
+        first_bin = (self.event_time - self.origin) // self.bin_size
+        last_bin = (horizon - self.origin) // self.bin_size
+        self._extend_open(max(first_bin, self.open_from), last_bin)
+        bin_origin = self.origin + self.open_from * self.bin_size
+
+        o = np.lexsort((times, groups))
+        times, groups, d_up, d_present = times[o], groups[o], d_up[o], d_present[o]
+        bounds = np.searchsorted(groups, np.arange(len(self.groups) + 1))
+        for group in range(len(self.groups)):
+            t = times[bounds[group]:bounds[group + 1]]
+            if len(t) == 0 and self.present_count[group] == 0:
+                continue
+            starts = np.concatenate([[self.event_time], t])
+            ends = np.concatenate([t, [horizon]])
+            up = self.up_count[group] + np.concatenate([[0], np.cumsum(d_up[bounds[group]:bounds[group + 1]])])
+            present = self.present_count[group] + np.concatenate([[0], np.cumsum(d_present[bounds[group]:bounds[group + 1]])])
+            rows = np.zeros(len(starts), dtype=np.int64)
+            engine._add_to_bins(self.open_up[group:group + 1], rows, starts, ends, up, bin_origin, self.bin_size)
+            engine._add_to_bins(self.open_present[group:group + 1], rows, starts, ends, present, bin_origin, self.bin_size)
+            self.up_count[group] = up[-1]
+            self.present_count[group] = present[-1]
+
+    def _extend_open(self, first_bin, last_bin):
+        # Make sure bins first_bin..last_bin are open
+        if self.open_up.shape[1] == 0:
+            self.open_from = first_bin
+        extra = last_bin + 1 - (self.open_from + self.open_up.shape[1])
+        if extra > 0:
+            pad = np.zeros((len(self.groups), extra), dtype=np.int64)
+            self.open_up = np.concatenate([self.open_up, pad], axis=1)
+            self.open_present = np.concatenate([self.open_present, pad], axis=1)
+
+    def _finalize(self):
+        # Bins whose end event time has reached can no longer change
+        done = 0
+        if self.event_time is not None:
+            done = max(0, (self.event_time - self.origin) // self.bin_size - self.open_from)
+        done = min(done, self.open_up.shape[1])
+        result = _frames(self, self.open_up[:, :done], self.open_present[:, :done], self.open_from)
+        self.open_up = self.open_up[:, done:]
+        self.open_present = self.open_present[:, done:]
+        self.open_from += done
+        return result
+
+    def bins(self):
+        # (up_time, present_time) so far for the bins that are still open
+        return _frames(self, self.open_up, self.open_present, self.open_from)
+
+
+def _frames(uptime, up, present, first_bin):
+    # Two DataFrames of Timedeltas, indexed by `by` value, with a column per bin (labelled by its start), from
+    # the (groups, bins) arrays of a StreamingUptime or live.LiveUptime, starting at bin number first_bin
+    origin = 0 if uptime.origin is None else uptime.origin
+    return query._frames(up, present, pd.Index(list(uptime.groups), name=uptime.by),
+                         origin + first_bin * uptime.bin_size, uptime.bin_size)
+
+
+if __name__ == "__main__":
+    import sys
+    import sample
+
+    print("FUNCTIONAL TEST")
+    df = sample.pointfile()
+    whole = StreamingUptime(sample.TIMEOUT, sample.BIN_SIZE)
+    up, present = whole.update(df)
+    print("Up time\n", up, "\nPresent time\n", present)
+
+    # The same data as two pointfiles, the second starting with a keyframe of every device's latest state
+    first, second = df.iloc[:8], df.iloc[8:]
+    keyframe = first.assign(version=first.groupby("$id")["version"].ffill()).groupby("$id").tail(1)
+    split = StreamingUptime(sample.TIMEOUT, sample.BIN_SIZE)
+    up1, present1 = split.update(first)
+    up2, present2 = split.update(pd.concat([keyframe, second]), keyframe=len(keyframe))
+    ok = pd.concat([up1, up2], axis=1).equals(up) and pd.concat([present1, present2], axis=1).equals(present)
+
+    # Snapshotted after the first pointfile and restored, carrying on gives the same
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "snapshot")
+    resumed = StreamingUptime(sample.TIMEOUT, sample.BIN_SIZE)
+    up1, present1 = resumed.update(first)
+    resumed.snapshot(path)
+    resumed = StreamingUptime.restore(path)
+    resumed.snapshot(path)  # Into the directory it is mapped from
+    resumed = StreamingUptime.restore(path)
+    up2, present2 = resumed.update(pd.concat([keyframe, second]), keyframe=len(keyframe))
+    ok &= pd.concat([up1, up2], axis=1).equals(up) and pd.concat([present1, present2], axis=1).equals(present)
+
+    # A larger fleet, restored, updated and snapshotted back into the same directory
+    import benchmark
+    fleet = benchmark.fleet(100_000, span=pd.Timedelta(minutes=30))
+    half = fleet["$ts"] < fleet["$ts"].iloc[0] + pd.Timedelta(minutes=15)
+    expected = StreamingUptime("15min", "5min")
+    expected.update(fleet[half])
+    expected.update(fleet[~half])
+    resumed = StreamingUptime("15min", "5min")
+    resumed.update(fleet[half])
+    resumed.snapshot(path)
+    resumed = StreamingUptime.restore(path)
+    resumed.update(fleet[~half].iloc[:1000])
+    resumed.snapshot(path)
+    resumed = StreamingUptime.restore(path)
+    resumed.update(fleet[~half].iloc[1000:])
+    ok &= all(a.equals(b) for a, b in zip(resumed.bins(), expected.bins())) and not any(f.endswith(".tmp.npy") for f in os.listdir(path))
+    if ok:
+        print("PASSED\n")
+    else:
+        print("FAILED")
+        sys.exit(-1)
@@ -3,7 +3,8 @@ import numpy as np
 import datetime
 import time
 import sys
-from line_profiler import LineProfiler
+import engine
+import profiling
 
 
 TIMEOUT = pd.Timedelta(minutes=15)  # How long does a device have to be silent before we deem it to be offline?
@@ -56,32 +57,69 @@ expected_rows = [
                 [pd.Timestamp("2021-01-01 00:54:00"), "C", False]
     ]
 
-def timeout(df, timeout):
-    print(df.index.is_monotonic, df.index.is_unique)
-
-    gid = df.groupby("$id") # Leaving default sorted=True seems to make everything faster overall?!
-    df["version"] = gid["version"].ffill()
-
-    delayed = df.copy(deep=True)    # Add a "potential timeout" after each event
-    delayed["$ts"] += timeout
-
-    df["count"] = gid.cumcount()    # Count each event (cumcount() produces floats which is a bit strange, but they seem to run faster than int64 - probably because of NaN detection)
-
-    df = pd.concat([df, delayed])   # Merge in the potential timeouts
-    df = df.sort_values(by="$ts", kind="mergesort")
-
-    gid = df.groupby("$id") # Todo - *assume* we need to redo group because we've added rows, unless Pandas is clever-enough not to need this?!
-    df["count"] = gid["count"].ffill()
+def timeout(df, timeout, prop=None, timer="count"):
+    # timeout is one Timedelta for every device, or a mapping (dict or Series) of $id -> Timedelta.
+    # If prop is given, only the rows that report that property count, i.e. it is the property that times out.
+    # timer="count" (the reference) sums the time deltas within each event's segment; timer="origin" gets the
+    # same timer from the time since each segment's origin, without the groupby on ("$id", "count")
+    if prop is not None:
+        df = df[df[prop].notna()].copy()
+    n = len(df)
+
+    with profiling.stage("ffill", n) as s:
+        gid = df.groupby("$id") # Leaving default sorted=True seems to make everything faster overall?!
+        df["version"] = gid["version"].ffill()
+        s.rows_out = n
+
+    if isinstance(timeout, (dict, pd.Series)):  # Per-device timeouts travel with the rows
+        df["timeout"] = pd.to_timedelta(np.asarray(df["$id"].map(timeout), dtype=object))
+        if df["timeout"].isna().any():
+            raise ValueError("No timeout given for devices " + str(list(df.loc[df["timeout"].isna(), "$id"].unique())))
+        timeout = df["timeout"]
+
+    with profiling.stage("merge", n) as s:
+        delayed = df.copy(deep=True)    # Add a "potential timeout" after each event
+        delayed["$ts"] += timeout
+
+        if timer == "count":
+            df["count"] = gid.cumcount()    # Count each event (cumcount() produces floats which is a bit strange, but they seem to run faster than int64 - probably because of NaN detection)
+        else:
+            df["real"] = True   # Mark the real events
+            delayed["real"] = False
+
+        df = pd.concat([df, delayed])   # Merge in the potential timeouts
+        df = df.sort_values(by="$ts", kind="mergesort")
+
+        gid = df.groupby("$id") # Todo - *assume* we need to redo group because we've added rows, unless Pandas is clever-enough not to need this?!
+        if timer == "count":
+            df["count"] = gid["count"].ffill()
+        s.rows_out = len(df)
 
     # Calculate timeouts
-    df["time_delta"] = df['$ts'] - gid["$ts"].shift(1)    # Backward-looking
-    df["timer"] = df.groupby(["$id","count"])["time_delta"].cumsum()    # this group-by is slow - not the cumsum()
-    df["up"] = df["timer"] <= TIMEOUT 
+    with profiling.stage("timer", len(df)) as s:
+        previous = gid["$ts"].shift(1)
+        df["time_delta"] = df['$ts'] - previous    # Backward-looking
+        if timer == "count":
+            df["timer"] = df.groupby(["$id","count"])["time_delta"].cumsum()    # this group-by is slow - not the cumsum()
+        else:
+            # The timer runs from the "origin" of each segment: the row before the segment's real event (a
+            # device's first event is its own origin). Potential timeouts take the origin of their device's
+            # latest real event. Origins never go backwards, so forward-filling them is a running maximum per
+            # device - one pass, with none of the sorting that a grouped ffill() does
+            real = df["real"].to_numpy()
+            origin = previous.fillna(df["$ts"]).to_numpy(dtype="datetime64[ns]").view(np.int64)   # Whatever the resolution of $ts
+            df["origin"] = np.where(real, origin, np.iinfo(np.int64).min)
+            df["origin"] = gid["origin"].cummax().to_numpy().view("datetime64[ns]")
+            df["timer"] = (df["$ts"] - df["origin"]).where(df["time_delta"].notna())
+        df["up"] = df["timer"] <= (df["timeout"] if "timeout" in df else timeout)
+        s.rows_out = len(df)
 
     # Eventify
-    df["up_changed"] = df["up"] != gid["up"].shift(1) 
+    with profiling.stage("eventify", len(df)) as s:
+        df["up_changed"] = df["up"] != gid["up"].shift(1) 
 
-    df = df[df["up_changed"] == True]
+        df = df[df["up_changed"] == True]
+        s.rows_out = len(df)
 
     return df
 
@@ -89,43 +127,105 @@ def run_timeout():
     global df_big
     return timeout(df_big, TIMEOUT)
 
-
-print("FUNCTIONAL TEST")
-# Create data
-df = pd.DataFrame(rows, columns = names)
-
-df = timeout(df, TIMEOUT)
-df = df[["$ts", "$id", "up"]].reset_index(drop=True)
-print("Results\n", df)
-
-expected = pd.DataFrame(expected_rows, columns = expected_names)
-if df.equals(expected):
+def run_engine():
+    global df_big
+    return engine.timeout_transitions(df_big, TIMEOUT)
+
+
+if __name__ == "__main__":
+    print("FUNCTIONAL TEST")
+    # Create data
+    df = pd.DataFrame(rows, columns = names)
+
+    df = timeout(df, TIMEOUT)
+    df = df[["$ts", "$id", "up"]].reset_index(drop=True)
+    print("Results\n", df)
+
+    expected = pd.DataFrame(expected_rows, columns = expected_names)
+    if df.equals(expected):
+        print("PASSED\n")
+    else:
+        print("FAILED\nExpected:\n", expected)
+        sys.exit(-1)
+
+    # The same with either timer, whatever the resolution of the timestamps (e.g. microseconds from Parquet)
+    for timer in ("count", "origin"):
+        for unit in ("ns", "us"):
+            df = pd.DataFrame(rows, columns = names)
+            df["$ts"] = df["$ts"].astype("datetime64[" + unit + "]")
+            df = timeout(df, TIMEOUT, timer=timer)[["$ts", "$id", "up"]].reset_index(drop=True)
+            if not df.equals(expected.assign(**{"$ts": expected["$ts"].astype("datetime64[" + unit + "]")})):
+                print("FAILED with the", timer, "timer and $ts in", unit, "\n", df)
+                sys.exit(-1)
     print("PASSED\n")
-else:
-    print("FAILED\nExpected:\n", expected)
-    sys.exit(-1)
-
-
-print("PERFORMANCE TEST")
-df_big = pd.DataFrame(rows, columns = names)
-for i in range(16):
-    df2 = df_big.copy()    # Create an identical dataframe later in time
-    span = df2["$ts"].iloc[-1] - df2["$ts"].iloc[0]
-    df2["$ts"] += span
-    df_big = pd.concat([df_big, df2], ignore_index=True)    # Ignore index so we get a nice monotonic, non-duplicate index (which will make some functions much faster)
-df_big['$id'] = np.random.randint(1, 100_000, df_big.shape[0])  # 100,000 IDs
-df_big['$id'] = df_big['$id'].astype("category")    # IDs are arguably categorical, which improves speed. Or they are pd.StringDtype() which is slower. They are not numbers.
-
-lprofiler = LineProfiler()
-lprofiler.add_function(timeout)
-lp_wrapper = lprofiler(run_timeout)
-t1 = time.time()
-lp_wrapper()
-t2 = time.time()
-lprofiler.print_stats()
-
-print("Took {time:,}ms to do {rows:,} rows, which is {speed:,} rows/sec".format(
-    time=int((t2-t1)*1000),
-    rows=len(df_big),
-    speed=int(len(df_big)/(t2-t1)))
-)
+
+    df = engine.timeout_transitions(pd.DataFrame(rows, columns = names), TIMEOUT)
+    print("Engine results\n", df)
+    if df.equals(expected):
+        print("PASSED\n")
+    else:
+        print("FAILED\nExpected:\n", expected)
+        sys.exit(-1)
+
+    # Per-device timeouts: B is given longer before it is deemed offline
+    timeouts = {"A": TIMEOUT, "B": pd.Timedelta(minutes=40), "C": TIMEOUT}
+    df = timeout(pd.DataFrame(rows, columns = names), timeouts)[["$ts", "$id", "up"]].reset_index(drop=True)
+    print("Per-device timeout results\n", df)
+    origin_df = timeout(pd.DataFrame(rows, columns = names), timeouts, timer="origin")[["$ts", "$id", "up"]].reset_index(drop=True)
+    if (df.equals(engine.timeout_transitions(pd.DataFrame(rows, columns = names), timeouts)) and df.equals(origin_df)
+            and df.loc[df["$id"] == "B", "up"].tolist() == [False, True, False]):
+        print("PASSED\n")
+    else:
+        print("FAILED")
+        sys.exit(-1)
+
+
+    print("PERFORMANCE TEST")
+    df_big = pd.DataFrame(rows, columns = names)
+    for i in range(16):
+        df2 = df_big.copy()    # Create an identical dataframe later in time
+        span = df2["$ts"].iloc[-1] - df2["$ts"].iloc[0]
+        df2["$ts"] += span
+        df_big = pd.concat([df_big, df2], ignore_index=True)    # Ignore index so we get a nice monotonic, non-duplicate index (which will make some functions much faster)
+    df_big['$id'] = np.random.randint(1, 100_000, df_big.shape[0])  # 100,000 IDs
+    df_big['$id'] = df_big['$id'].astype("category")    # IDs are arguably categorical, which improves speed. Or they are pd.StringDtype() which is slower. They are not numbers.
+
+    with profiling.Profile() as engine_profile:
+        t1 = time.time()
+        engine_result = run_engine()  # Run first, as timeout() modifies df_big
+        t2 = time.time()
+    print(engine_profile.report())
+    print("Engine took {time:,}ms to do {rows:,} rows, which is {speed:,} rows/sec".format(
+        time=int((t2-t1)*1000),
+        rows=len(df_big),
+        speed=int(len(df_big)/(t2-t1)))
+    )
+
+    with profiling.Profile() as profile:
+        t1 = time.time()
+        result = run_timeout()
+        t2 = time.time()
+    print(profile.report())
+
+    print("Took {time:,}ms to do {rows:,} rows, which is {speed:,} rows/sec".format(
+        time=int((t2-t1)*1000),
+        rows=len(df_big),
+        speed=int(len(df_big)/(t2-t1)))
+    )
+
+    if not result[["$ts", "$id", "up"]].reset_index(drop=True).equals(engine_result):
+        print("FAILED: engine does not match timeout()")
+        sys.exit(-1)
+
+    with profiling.Profile() as origin_profile:
+        t1 = time.time()
+        origin_result = timeout(df_big.copy(), TIMEOUT, timer="origin")
+        t2 = time.time()
+    print(origin_profile.report())
+    print("With the origin timer took {time:,}ms, which is {speed:,} rows/sec".format(
+        time=int((t2-t1)*1000),
+        speed=int(len(df_big)/(t2-t1)))
+    )
+    if not origin_result[["$ts", "$id", "up"]].equals(result[["$ts", "$id", "up"]]):
+        print("FAILED: the origin timer does not match the count timer")
+        sys.exit(-1)